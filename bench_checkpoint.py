@@ -0,0 +1,111 @@
+"""Time restoring and compacting the checkpoint of a rush-hour scraper.
+
+Builds a TerminalScraper holding --trains in-flight trains, each with
+--scrapes scrapes of a --lines line page, checkpoints it scrape by scrape
+as the scraping loop does (one save per simulated minute), then times:
+
+	restore -- Checkpoint.restore into a fresh scraper (replaying the log
+			   and compacting it)
+	compact -- Checkpoint.compact of the restored scraper
+
+	python bench_checkpoint.py --trains 500 --scrapes 60 --lines 20
+
+Half of the trains finish waiting on the uploader, so restore also
+submits them again. The log is written to a temporary directory.
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import transit_scraper as ts
+from checkpoint import Checkpoint
+
+START = datetime(2018, 4, 10, 7, 0)
+
+
+class HeldUploader:
+	"""Takes uploads and never sends them."""
+
+	def __init__(self):
+		self.on_upload = None
+		self.on_spool = None
+		self.uploaded = 0
+		self.failed = 0
+		self.submitted = 0
+
+	def depth(self):
+		return self.submitted
+
+	def submit(self, key, body):
+		self.submitted = self.submitted + 1
+
+
+def page(scrape, lines):
+	return [u"Station {}\xa0\xa0{}".format(n, "DEPARTED" if n < scrape * lines // 60
+										   else "at 8:{:02d}".format(n))
+			for n in range(lines)]
+
+
+def build(path, trains, scrapes, lines):
+	"""Checkpoint a scraper of trains at path; returns the log size in bytes."""
+	ts.clock = ts.SimulatedClock(START)
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path),
+								 uploader=HeldUploader())
+	for i in range(trains):
+		train = ts.Train(str(3000 + i), "Northeast Corrdr", "8:05")
+		scraper.current_trains[train.id] = train
+	for scrape in range(scrapes):
+		for train in scraper.current_trains.values():
+			train.data.append([ts.clock.now(), page(scrape, lines)])
+			train.page = train.data[-1][1]
+			train.scrape_count = train.scrape_count + 1
+		scraper.checkpoint.save(scraper)
+		ts.clock.sleep(60)
+	for train_id in list(scraper.current_trains)[:trains // 2]:
+		scraper.complete_train(train_id)
+	scraper.checkpoint.save(scraper)
+	scraper.checkpoint.log.close()
+	return os.path.getsize(path)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--trains', type=int, default=500)
+	parser.add_argument('--scrapes', type=int, default=60, help='scrapes per train')
+	parser.add_argument('--lines', type=int, default=20, help='lines per status page')
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	root = tempfile.mkdtemp()
+	path = os.path.join(root, 'checkpoint.log')
+	output = io.StringIO()
+	print("{} trains, {} scrapes of {} lines each".format(args.trains, args.scrapes, args.lines))
+	print("")
+	print("{:>4} {:>9} {:>11} {:>11} {:>9} {:>11}".format(
+		"run", "log MB", "restore s", "compact s", "current", "resubmitted"))
+	for run in range(args.repeat):
+		with redirect_stdout(output):
+			size = build(path, args.trains, args.scrapes, args.lines)
+		uploader = HeldUploader()
+		started = time.time()
+		with redirect_stdout(output):
+			scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path),
+										 uploader=uploader)
+		restored = time.time()
+		scraper.checkpoint.compact(scraper)
+		compacted = time.time()
+		scraper.checkpoint.log.close()
+		print("{:>4} {:>9.1f} {:>11.2f} {:>11.2f} {:>9} {:>11}".format(
+			run + 1, size / 1e6, restored - started, compacted - restored,
+			len(scraper.current_trains), uploader.submitted))
+		os.remove(path)
+	shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,175 @@
+"""Time transit_parser's S3 downloads against a local S3 stand-in.
+
+The recorded train files of one day are copied under several consecutive
+dates and served by s3_mock_server, with a latency per request:
+
+	python bench_download.py pipeline scraped_data/2018_04_10/ --days 4 --prefetch 0 1 2
+		runs download_and_parse_days over the days once per prefetch
+		setting (0 is download, then parse, day after day) and reports
+		end-to-end wall time
+
+	python bench_download.py download scraped_data/2018_04_10/ --download-workers 1 4 16
+		runs download_train_files over the days once per pool size and
+		reports objects per second, then re-runs it on the same directory
+		(every file skipped by the manifest) and after cutting every file
+		to a half-written .part (every file resumed with a Range request)
+
+Run from the repository root, the parser reads ./rail_data/. Downloads
+and CSVs are written to a temporary directory.
+"""
+import argparse
+import filecmp
+import io
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.config import Config
+
+import transit_parser as tp
+from s3_mock_server import MockS3, serve
+
+
+def setup(args, root):
+	"""Copy the recording under args.days dates, serve them and point
+	transit_parser at the server; returns (MockS3, server, date strings)."""
+	recording = os.path.join(args.recording, '')
+	first = datetime.strptime(os.path.basename(os.path.dirname(recording))[:10], "%Y_%m_%d")
+	days = []
+	for i in range(args.days):
+		date_string = (first + timedelta(days=i)).strftime("%Y_%m_%d")
+		directory = os.path.join(root, tp.BUCKET, date_string)
+		os.makedirs(directory)
+		for filename in os.listdir(recording):
+			if not filename.startswith("."):
+				shutil.copy(recording + filename, os.path.join(directory, date_string + filename[10:]))
+		days.append(date_string)
+
+	s3 = MockS3(os.path.join(root, tp.BUCKET), latency=args.latency, error_rate=args.error_rate)
+	server = serve(s3)
+	tp.s3 = boto3.resource('s3', endpoint_url="http://127.0.0.1:{}".format(server.server_port),
+						   aws_access_key_id='mock', aws_secret_access_key='mock',
+						   region_name='us-east-1',
+						   config=Config(max_pool_connections=tp.S3_CONNECTIONS))
+	print("serving {} objects over {} days, latency {}s".format(len(s3.keys), len(days),
+																args.latency))
+	return s3, server, days
+
+
+def pipeline(args):
+	root = tempfile.mkdtemp()
+	s3, server, days = setup(args, root)
+
+	print("")
+	print("{:>9} {:>10} {:>10}".format("prefetch", "seconds", "s/day"))
+	for prefetch in args.prefetch:
+		run_root = tempfile.mkdtemp(dir=root)
+		data_path, csv_path = run_root + '/data/', run_root + '/csv/'
+		os.makedirs(csv_path)
+		started = time.time()
+		output = io.StringIO()
+		with redirect_stdout(output):
+			tp.download_and_parse_days(days, data_path, workers=args.workers,
+									   prefetch=prefetch, csv_path=csv_path)
+		elapsed = time.time() - started
+		if args.verbose:
+			print(output.getvalue())
+		print("{:>9} {:>10.1f} {:>10.1f}".format(prefetch, elapsed, elapsed / len(days)))
+		shutil.rmtree(run_root, ignore_errors=True)
+	print("requests: {}".format(s3.counts))
+	server.shutdown()
+	shutil.rmtree(root, ignore_errors=True)
+
+
+def download_days(days, path, workers):
+	"""Download the days; returns (seconds, files downloaded, files skipped)."""
+	started = time.time()
+	downloaded, skipped = 0, 0
+	for date_string in days:
+		counts = tp.download_train_files(date_string, path, workers=workers)
+		downloaded, skipped = downloaded + counts[0], skipped + counts[1]
+	return time.time() - started, downloaded, skipped
+
+
+def interrupt(directory):
+	"""Replace each file by the first half of it, as if its download had been
+	cut off, and forget it in the manifest."""
+	manifest = tp.DownloadManifest(directory)
+	for filename in list(manifest.files):
+		etag = manifest.files.pop(filename)['etag']
+		with open(directory + filename, 'rb') as infile:
+			body = infile.read()
+		with open(tp.part_filename(directory, filename, etag), 'wb') as outfile:
+			outfile.write(body[:len(body) // 2])
+		os.remove(directory + filename)
+	manifest.save()
+
+
+def same_files(days, path, root):
+	for date_string in days:
+		served = os.path.join(root, tp.BUCKET, date_string)
+		match, mismatch, errors = filecmp.cmpfiles(served, path + date_string, os.listdir(served),
+												   shallow=False)
+		if mismatch or errors:
+			return False
+	return True
+
+
+def download(args):
+	root = tempfile.mkdtemp()
+	s3, server, days = setup(args, root)
+	total_bytes = sum(obj.size for obj in s3.objects.values())
+
+	print("")
+	print("{:<8} {:>8} {:>9} {:>11} {:>10} {:>9} {:>6}".format(
+		"run", "workers", "seconds", "objects/s", "fetched", "skipped", "same"))
+
+	def report(run, workers, path, result):
+		seconds, downloaded, skipped = result
+		print("{:<8} {:>8} {:>9.2f} {:>11.1f} {:>10} {:>9} {:>6}".format(
+			run, workers, seconds, (downloaded + skipped) / seconds, downloaded, skipped,
+			str(same_files(days, path, root))))
+
+	for workers in args.download_workers:
+		data_path = tempfile.mkdtemp(dir=root) + '/'
+		report("fresh", workers, data_path, download_days(days, data_path, workers))
+	workers = args.download_workers[-1]
+	report("re-run", workers, data_path, download_days(days, data_path, workers))
+
+	for date_string in days:
+		interrupt(data_path + date_string + '/')
+	s3.bytes_sent, s3.counts = 0, {}
+	report("resumed", workers, data_path, download_days(days, data_path, workers))
+	print("resumed {} range requests, {} of {} bytes sent".format(
+		s3.counts.get("range", 0), s3.bytes_sent, total_bytes))
+	server.shutdown()
+	shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('mode', choices=['pipeline', 'download'])
+	parser.add_argument('recording', help='directory of one day of train files, named YYYY_MM_DD')
+	parser.add_argument('--days', type=int, default=4)
+	parser.add_argument('--prefetch', type=int, nargs='+', default=[0, 1, 2],
+						help='download_and_parse_days prefetch settings (pipeline mode)')
+	parser.add_argument('--workers', type=int, default=None, help='parser processes')
+	parser.add_argument('--download-workers', type=int, nargs='+', default=[1, 4, 16, 32],
+						help='download_train_files pool sizes (download mode)')
+	parser.add_argument('--latency', type=float, default=0.02)
+	parser.add_argument('--error-rate', type=float, default=0.0)
+	parser.add_argument('--verbose', action='store_true', help='show the parser output')
+	args = parser.parse_args()
+
+	if args.mode == 'pipeline':
+		pipeline(args)
+	else:
+		download(args)
+
+
+if __name__ == "__main__":
+	main()
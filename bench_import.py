@@ -0,0 +1,68 @@
+"""Time importing the scraper and the parser, and their first schedule lookup.
+
+Each run is a fresh interpreter that imports a module, then makes its first
+get_schedule() lookup, which loads the ScheduleIndex:
+
+	cold -- rail_data/.schedule_cache.pickle is removed first, so the index
+			is built from the GTFS CSVs (and the cache written again)
+	warm -- the cache is in place and is loaded
+
+	python bench_import.py --repeat 5
+
+reports the median of --repeat runs of each. Run from the repository root.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from rail_data.schedule import CACHE_FILE
+
+RAIL_DATA = "./rail_data/"
+MODULES = ["transit_scraper", "transit_parser"]
+
+RUN = """
+import json, time
+from datetime import datetime
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from rail_data.schedule import get_schedule
+get_schedule({module}.RAIL_DATA).first_arrival(datetime(2018, 4, 10), "3837")
+print(json.dumps([imported - started, time.perf_counter() - imported]))
+"""
+
+
+def run(module, cold):
+	"""(import seconds, first lookup seconds) in a fresh interpreter."""
+	if cold and os.path.exists(RAIL_DATA + CACHE_FILE):
+		os.remove(RAIL_DATA + CACHE_FILE)
+	output = subprocess.check_output([sys.executable, "-c", RUN.format(module=module)])
+	return json.loads(output.decode('utf-8').strip().split("\n")[-1])
+
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--modules', nargs='+', default=MODULES, choices=MODULES)
+	args = parser.parse_args()
+
+	print("{:<16} {:<5} {:>9} {:>13} {:>8}".format("module", "cache", "import s", "first get s",
+												   "total s"))
+	for module in args.modules:
+		for cold in [True, False]:
+			runs = [run(module, cold) for _ in range(args.repeat)]
+			imported = median([r[0] for r in runs])
+			lookup = median([r[1] for r in runs])
+			print("{:<16} {:<5} {:>9.2f} {:>13.2f} {:>8.2f}".format(
+				module, "cold" if cold else "warm", imported, lookup, imported + lookup))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,339 @@
+"""Drive the real TerminalScraper against a local DepartureVision stand-in.
+
+Four modes:
+
+	python bench_load.py run --duration 300 --trains 200
+		runs the scraping loop at real speed and reports throughput, the
+		requests the server answered and how closely scrapes kept to their
+		scheduled t_scrape
+
+	python bench_load.py burst --sizes 50 200 500
+		makes every train of a batch due at once and times a single
+		scrape_trains call, i.e. the train half of one scraping loop
+
+	python bench_load.py terminals --rounds 5
+		makes every terminal due at once and times the terminal half of a
+		scraping loop: fetching and merging the boards, then finding and
+		creating trains
+
+	python bench_load.py delays --duration 60 --clients 8
+		runs the scraper with a delay_service.DelayIndex, and once trains
+		are indexed queries it over HTTP from several clients for duration
+		seconds while the scraper keeps running
+
+	python bench_load.py day --start "2018-04-10 05:00" --trains 1000 --stale-rate 0.05
+		runs a whole day on a simulated clock, without HTTP or sleeping,
+		once with Train.expiry and once without, where stale-rate of the
+		trains never show DEPARTED at their final stop; reports the train
+		page requests and how many trains completed, expired or were
+		still being scraped at the end
+
+Completed trains are written to a temporary directory, nothing is
+uploaded to S3.
+"""
+import argparse
+import io
+import random
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import requests
+
+import transit_scraper as ts
+from delay_service import DelayIndex
+from dv_mock_server import MockDepartureVision, serve
+from metrics import LAG_BUCKETS
+from uploader import TrainUploader, FileBackend
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def wait(scraper, deadline):
+	"""scraper.wait(), returning by deadline (a time.time() value)."""
+	next_time = scraper.queue.next_time()
+	if next_time is None:
+		delay = scraper.retry_delay
+	else:
+		delay = (next_time - ts.clock.now()).total_seconds()
+	delay = min(delay, deadline - time.time())
+	if delay > 0:
+		ts.clock.sleep(delay)
+
+
+def setup(args, trains):
+	ts.clock = ts.OffsetClock(datetime.strptime(args.start, "%Y-%m-%d %H:%M"))
+	dv = MockDepartureVision(ts.clock, trains=trains, latency=args.latency,
+							 error_rate=args.error_rate)
+	server = serve(dv)
+	base_url = "http://127.0.0.1:{}/mobile/".format(server.server_port)
+	ts.Train.url = base_url + "train_stops.aspx?train="
+	ts.TerminalScraper.terminal_url = base_url + "tid-mobile.aspx?sid="
+	print("serving {} trains from {}".format(len(dv.trains), ts.clock.now()))
+	return dv, server
+
+
+def lag_report(kind):
+	histogram = ts.METRICS.histogram("scrape_lag_seconds", "Delay between t_scrape and the scrape",
+									 buckets=LAG_BUCKETS, kind=kind)
+	count = sum(histogram.counts)
+	if not count:
+		return "{}: no scrapes".format(kind)
+	within, cumulative = [], 0
+	for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+		cumulative = cumulative + bucket_count
+		within.append("<={}s {:.1%}".format(bound, cumulative / count))
+	return "{}: {} scrapes, mean lag {:.2f}s, {}".format(kind, count, histogram.sum / count,
+														  ", ".join(within))
+
+
+def run(args):
+	dv, server = setup(args, args.trains)
+	root = tempfile.mkdtemp()
+	uploader = TrainUploader(FileBackend(root), spool_dir=root + '/spool/')
+	scraper = ts.TerminalScraper(max_workers=args.workers, uploader=uploader,
+								 polling=ts.TerminalPolling(ts.TERMINALS))
+
+	step_times = []
+	started = time.time()
+	deadline = started + args.duration
+	while time.time() < deadline:
+		step_started = time.time()
+		scraper.step()
+		step_times.append(time.time() - step_started)
+		wait(scraper, deadline)
+	elapsed = time.time() - started
+	uploader.close(timeout=10)
+	server.shutdown()
+
+	requests_served = sum(dv.counts.values())
+	print("")
+	print("{:.0f}s, {} loops, {} active trains, {} completed".format(
+		elapsed, len(step_times), len(scraper.current_trains), len(scraper.completed_trains)))
+	print("requests: {} ({:.1f}/s), {}".format(requests_served, requests_served / elapsed,
+											   dv.counts))
+	print("client: {}".format(ts.DV.stats()))
+	print("loop seconds: median {:.3f}, p95 {:.3f}, max {:.3f}".format(
+		percentile(step_times, 0.5), percentile(step_times, 0.95), max(step_times)))
+	print(lag_report(ts.TERMINAL))
+	print(lag_report(ts.TRAIN))
+	shutil.rmtree(root, ignore_errors=True)
+
+
+def burst(args):
+	dv, server = setup(args, max(args.sizes))
+	scraper = ts.TerminalScraper(max_workers=args.workers)
+	# nearest to the start time first, see MockDepartureVision
+	train_ids = list(dv.trains)
+
+	print("")
+	print("{:>6} {:>10} {:>10} {:>10}".format("trains", "loop s", "req/s", "scraped"))
+	for size in args.sizes:
+		trains = [ts.Train(train_id, dv.trains[train_id].line, "") for train_id in train_ids[:size]]
+		now = ts.clock.now()
+		for train in trains:
+			train.t_scrape = now
+		started = time.time()
+		scraper.scrape_trains(trains)
+		elapsed = time.time() - started
+		scraped = sum(1 for train in trains if train.scrape_count)
+		print("{:>6} {:>10.3f} {:>10.1f} {:>10}".format(size, elapsed, size / elapsed, scraped))
+	server.shutdown()
+
+
+def terminals(args):
+	dv, server = setup(args, args.trains)
+	scraper = ts.TerminalScraper(max_workers=args.workers)
+	names = list(scraper.terminals)
+
+	print("")
+	print("{:>6} {:>10} {:>10} {:>8} {:>6}".format("round", "fetch s", "trains s", "unique", "new"))
+	for round_number in range(args.rounds):
+		scraper.time = ts.clock.now()
+		started = time.time()
+		rows = scraper.scrape_terminals(names)
+		fetched = time.time()
+		new_trains = scraper.find_new_trains(rows)
+		scraper.create_new_trains(new_trains)
+		finished = time.time()
+		print("{:>6} {:>10.3f} {:>10.4f} {:>8} {:>6}".format(
+			round_number + 1, fetched - started, finished - fetched, len(rows), len(new_trains)))
+	server.shutdown()
+
+
+def delays(args):
+	dv, server = setup(args, args.trains)
+	root = tempfile.mkdtemp()
+	uploader = TrainUploader(FileBackend(root), spool_dir=root + '/spool/')
+	index = DelayIndex(ts.ALL_STATIONS)
+	service = index.serve(0)
+	scraper = ts.TerminalScraper(max_workers=args.workers, uploader=uploader,
+								 polling=ts.TerminalPolling(ts.TERMINALS), delays=index)
+
+	stop = threading.Event()
+
+	def scrape():
+		while not stop.is_set():
+			scraper.step()
+			scraper.wait()
+
+	scraper_thread = threading.Thread(target=scrape)
+	scraper_thread.daemon = True
+	scraper_thread.start()
+	while len(index.trains) < 10:
+		time.sleep(1)
+	print("{} trains indexed on {} lines".format(len(index.trains), len(index.lines)))
+
+	lines = list(index.lines)
+	train_ids = list(index.trains)
+	number = 2000
+	print("in process: line_delays {:.1f}us, train_status {:.1f}us".format(
+		timeit.timeit(lambda: index.line_delays(random.choice(lines)), number=number) / number * 1e6,
+		timeit.timeit(lambda: index.train_status(random.choice(train_ids)), number=number) / number * 1e6))
+
+	base_url = "http://127.0.0.1:{}/".format(service.server_port)
+	latencies = []
+	lock = threading.Lock()
+
+	def query(seed):
+		session = requests.Session()
+		rand = random.Random(seed)
+		timings = []
+		end = time.time() + args.duration
+		while time.time() < end:
+			if rand.random() < 0.5:
+				url = base_url + "delays?line=" + rand.choice(lines)
+			else:
+				url = base_url + "train?id=" + rand.choice(train_ids)
+			started = time.time()
+			session.get(url)
+			timings.append(time.time() - started)
+		with lock:
+			latencies.extend(timings)
+
+	clients = [threading.Thread(target=query, args=(i,)) for i in range(args.clients)]
+	for client in clients:
+		client.start()
+	for client in clients:
+		client.join()
+	stop.set()
+	service.shutdown()
+	server.shutdown()
+
+	print("{} queries from {} clients: {:.0f}/s, latency p50 {:.2f}ms, p99 {:.2f}ms".format(
+		len(latencies), args.clients, len(latencies) / args.duration,
+		percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+	print("scraper kept running: {} trains indexed, {} train pages served".format(
+		len(index.trains), dv.counts.get('train_stops.aspx', 0)))
+	shutil.rmtree(root, ignore_errors=True)
+
+
+class NoExpiry:
+	"""Never retires a train, as before ScheduleExpiry."""
+
+	def check(self, train, now):
+		return None
+
+
+class DirectTrain(ts.Train):
+	"""Requests its page from the stand-in without HTTP."""
+	__slots__ = ()
+	dv = None
+
+	def request(self, timeout=3, retry=False):
+		return self.parse_table(self.dv.respond("train_stops.aspx", {"train": [self.id]})[1])
+
+
+class DirectScraper(ts.TerminalScraper):
+	dv = None
+	expired = 0
+
+	def complete_train(self, train_id):
+		if self.current_trains[train_id].expired is not None:
+			self.expired = self.expired + 1
+		ts.TerminalScraper.complete_train(self, train_id)
+
+	def get_departures(self, abbrev):
+		return self.parse_table(self.dv.respond("tid-mobile.aspx", {"sid": [abbrev]})[1])
+
+
+def day(args):
+	start = datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+	end = datetime.strptime(args.end, "%Y-%m-%d %H:%M")
+	root = tempfile.mkdtemp()
+
+	print("{:<10} {:>9} {:>9} {:>10} {:>8} {:>8} {:>7}".format(
+		"expiry", "train req", "term req", "completed", "expired", "active", "secs"))
+	for name, expiry in [("none", NoExpiry()), ("schedule", ts.ScheduleExpiry())]:
+		ts.clock = ts.SimulatedClock(start)
+		dv = MockDepartureVision(ts.clock, trains=args.trains, latency=0,
+								 error_rate=args.error_rate, stale_rate=args.stale_rate)
+		train_class = type("DayTrain", (DirectTrain,), {"__slots__": (), "dv": dv,
+														 "expiry": expiry})
+		scraper_class = type("DayScraper", (DirectScraper,), {"dv": dv,
+															   "train_class": train_class})
+		uploader = TrainUploader(FileBackend(root), spool_dir=root + '/spool/')
+		started = time.time()
+		# the scraper prints every completed train
+		with redirect_stdout(io.StringIO()):
+			scraper = scraper_class(max_workers=1, uploader=uploader,
+									polling=ts.TerminalPolling(ts.TERMINALS))
+			while ts.clock.now() < end:
+				scraper.step()
+				scraper.wait()
+		uploader.close(timeout=10)
+		print("{:<10} {:>9} {:>9} {:>10} {:>8} {:>8} {:>7.1f}".format(
+			name, dv.counts.get("train_stops.aspx", 0), dv.counts.get("tid-mobile.aspx", 0),
+			len(scraper.completed_trains), scraper.expired, len(scraper.current_trains),
+			time.time() - started))
+	stale = sum(1 for train in dv.trains.values() if train.stale)
+	print("{} trains, {} of them stale".format(len(dv.trains), stale))
+	shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('mode', choices=['run', 'burst', 'terminals', 'delays', 'day'])
+	parser.add_argument('--start', default='2018-04-10 08:00',
+						help='simulated start time, within the GTFS calendar')
+	parser.add_argument('--trains', type=int, default=200,
+						help='trains running (run, terminals and day modes)')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 500],
+						help='batch sizes (burst mode)')
+	parser.add_argument('--rounds', type=int, default=5, help='terminal rounds (terminals mode)')
+	parser.add_argument('--duration', type=float, default=300,
+						help='seconds (run and delays modes)')
+	parser.add_argument('--clients', type=int, default=8, help='query threads (delays mode)')
+	parser.add_argument('--workers', type=int, default=None,
+						help='scraper max_workers (default TerminalScraper.max_workers)')
+	parser.add_argument('--end', default='2018-04-11 00:00',
+						help='simulated end time (day mode)')
+	parser.add_argument('--stale-rate', type=float, default=0.05,
+						help='fraction of trains never completing (day mode)')
+	parser.add_argument('--latency', type=float, default=0.05)
+	parser.add_argument('--error-rate', type=float, default=0.0)
+	args = parser.parse_args()
+
+	if args.mode == 'run':
+		run(args)
+	elif args.mode == 'burst':
+		burst(args)
+	elif args.mode == 'terminals':
+		terminals(args)
+	elif args.mode == 'delays':
+		delays(args)
+	else:
+		day(args)
+
+
+if __name__ == "__main__":
+	main()
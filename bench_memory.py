@@ -0,0 +1,101 @@
+"""Peak memory of a simulated weekday of completed trains.
+
+Each train is created, scraped --scrapes times (a fresh --lines line page
+every time, as the scraper gets from DepartureVision) and completed
+through TerminalScraper.complete_train, with an uploader that uploads
+straight away. Two ways of keeping completed trains are compared, each in
+a fresh process:
+
+	records -- what the scraper does: a CompletedTrain record per train,
+			   the Train and its pages are dropped once uploaded
+	trains -- every completed Train is kept with its pages, as
+			  completed_trains used to hold them
+
+	python bench_memory.py --trains 1500 --scrapes 100 --lines 20
+
+reports the peak resident set size of each process, and how much it grew
+over the day.
+"""
+import argparse
+import io
+import multiprocessing
+import resource
+from contextlib import redirect_stdout
+from datetime import datetime
+
+
+class InstantUploader:
+	"""Uploads every train as it is submitted, to nowhere."""
+
+	def __init__(self):
+		self.on_upload = None
+		self.on_spool = None
+		self.uploaded = 0
+		self.failed = 0
+
+	def depth(self):
+		return 0
+
+	def submit(self, key, body):
+		self.uploaded = self.uploaded + 1
+		self.on_upload(key)
+
+
+def peak_rss_mb():
+	# kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def simulate_day(mode, trains, scrapes, lines, results):
+	import transit_scraper as ts
+	ts.clock = ts.SimulatedClock(datetime(2018, 4, 10, 5, 0))
+	scraper = ts.TerminalScraper(max_workers=1, uploader=InstantUploader())
+	before = peak_rss_mb()
+	kept = []
+	# the scraper prints every completed train
+	output = io.StringIO()
+	for i in range(trains):
+		train = ts.Train(str(1000 + i), "Northeast Corrdr", "8:05")
+		for scrape in range(scrapes):
+			page = [u"Station {}\xa0\xa0at {}:{:02d}".format(n, 5 + scrape // 60, scrape % 60)
+					for n in range(lines)]
+			train.data.append([ts.clock.now(), page])
+			train.page = page
+		scraper.current_trains[train.id] = train
+		with redirect_stdout(output):
+			scraper.complete_train(train.id)
+		output.seek(0)
+		output.truncate()
+		if mode == "trains":
+			kept.append(train)
+		ts.clock.sleep(30)
+	results.put((mode, len(scraper.completed_trains), before, peak_rss_mb()))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--trains', type=int, default=1500)
+	parser.add_argument('--scrapes', type=int, default=100, help='scrapes per train')
+	parser.add_argument('--lines', type=int, default=20, help='lines per status page')
+	parser.add_argument('--modes', nargs='+', default=["records", "trains"],
+						choices=["records", "trains"])
+	args = parser.parse_args()
+
+	context = multiprocessing.get_context("spawn")
+	results = context.Queue()
+	print("{} trains, {} scrapes of {} lines each".format(args.trains, args.scrapes, args.lines))
+	print("")
+	print("{:<8} {:>9} {:>15} {:>13} {:>8}".format("mode", "trains", "rss at start MB",
+												   "peak rss MB", "grew MB"))
+	for mode in args.modes:
+		process = context.Process(target=simulate_day,
+								  args=(mode, args.trains, args.scrapes, args.lines, results))
+		process.start()
+		mode, completed, before, peak = results.get()
+		process.join()
+		print("{:<8} {:>9} {:>15.1f} {:>13.1f} {:>8.1f}".format(mode, completed, before, peak,
+																  peak - before))
+
+
+if __name__ == "__main__":
+	main()
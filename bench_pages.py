@@ -0,0 +1,123 @@
+"""Time dv_pages against BeautifulSoup on DepartureVision pages.
+
+Pages come from a local DepartureVision stand-in at one moment of a day:
+every terminal board and the status page of every running train.
+
+	python bench_pages.py --trains 200 --repeat 3
+
+parses each page with dv_pages (train_stops or departure_rows) and with
+BeautifulSoup(html, 'lxml') plus the find_all walks the scraper used to
+make, checks both give the same cells and reports pages per second. A
+tracemalloc snapshot is taken before and after parsing every page once
+with the parse tree kept (the TableExtractor or the soup), giving the
+bytes and blocks each parser allocates per page. Needs beautifulsoup4
+and lxml, which the scraper itself does not.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime
+
+import dv_pages
+import transit_scraper as ts
+from dv_mock_server import MockDepartureVision
+
+# bs4.BeautifulSoup, imported by main() so the scraper's requirements are
+# enough to import this module
+BeautifulSoup = None
+
+
+def soup_train_stops(html, keep=None):
+	soup = BeautifulSoup(html, "lxml")
+	if keep is not None:
+		keep.append(soup)
+	table = soup.find('table')
+	if table is None:
+		return []
+	return [td.text for td in table.find_all('td')]
+
+
+def soup_departure_rows(html, keep=None):
+	soup = BeautifulSoup(html, "lxml")
+	if keep is not None:
+		keep.append(soup)
+	return [[td.text for td in table.find_all('td')] for table in soup.find_all('table')
+			if table.parent.name == 'td']
+
+
+def extractor_train_stops(html, keep=None):
+	if keep is not None:
+		keep.append(dv_pages.TableExtractor().extract(html))
+	return dv_pages.train_stops(html)
+
+
+def extractor_departure_rows(html, keep=None):
+	if keep is not None:
+		keep.append(dv_pages.TableExtractor().extract(html))
+	return dv_pages.departure_rows(html)
+
+
+def allocated(fn, pages):
+	"""(bytes, blocks) per page allocated by fn with its parse trees kept."""
+	keep = []
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	for html in pages:
+		keep.append(fn(html, keep))
+	after = tracemalloc.take_snapshot()
+	tracemalloc.stop()
+	stats = after.compare_to(before, 'filename')
+	size = sum(stat.size_diff for stat in stats)
+	count = sum(stat.count_diff for stat in stats)
+	return size / float(len(pages)), count / float(len(pages))
+
+
+def best_time(fn, pages, repeat):
+	"""Fastest of repeat passes over pages, in seconds."""
+	best = None
+	for _ in range(repeat):
+		started = time.perf_counter()
+		for html in pages:
+			fn(html)
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--trains', type=int, default=200)
+	parser.add_argument('--start', default="2018-04-10 08:00",
+						help='moment of the GTFS feed the pages show')
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	global BeautifulSoup
+	from bs4 import BeautifulSoup
+
+	clock = ts.SimulatedClock(datetime.strptime(args.start, "%Y-%m-%d %H:%M"))
+	dv = MockDepartureVision(clock, trains=args.trains, latency=0)
+	boards = [dv.terminal_page(info['abbrev']) for info in ts.TERMINALS.values()]
+	trains = [dv.train_page(train_id) for train_id in dv.trains]
+	print("{} board pages, {} train pages".format(len(boards), len(trains)))
+
+	print("")
+	print("{:<16} {:<9} {:>6} {:>9} {:>9} {:>11} {:>6}".format(
+		"pages", "parser", "count", "pages/s", "speedup", "bytes/page", "blocks"))
+	for name, pages, fast, slow in [("departure_rows", boards, extractor_departure_rows,
+									 soup_departure_rows),
+									("train_stops", trains, extractor_train_stops,
+									 soup_train_stops)]:
+		same = all(fast(html) == slow(html) for html in pages)
+		fast_time = best_time(fast, pages, args.repeat)
+		slow_time = best_time(slow, pages, args.repeat)
+		for parser_name, fn, seconds in [("dv_pages", fast, fast_time), ("soup", slow, slow_time)]:
+			size, count = allocated(fn, pages)
+			print("{:<16} {:<9} {:>6} {:>9.0f} {:>8.1f}x {:>11.0f} {:>6.0f}".format(
+				name, parser_name, len(pages), len(pages) / seconds, slow_time / seconds,
+				size, count))
+		print("{:<16} same cells: {}".format(name, same))
+
+
+if __name__ == "__main__":
+	main()
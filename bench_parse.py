@@ -0,0 +1,104 @@
+"""Time DayParser.parse_all_trains over a synthetic day at several pool sizes.
+
+The day is built from the GTFS schedule by the DepartureVision stand-in:
+every train running on the date is scraped every --freq seconds from
+before its first departure until its last stop shows DEPARTED, and each
+train is written as a train file the way the scraper writes it.
+
+	python bench_parse.py --date 2018-04-10 --workers 1 2 4 8
+
+parses the day once per pool size (1 is the serial parse), checks each
+result equals the serial one and reports wall time and speedup. Run from
+the repository root, the parser reads ./rail_data/. Files and CSVs are
+written to a temporary directory, or to --keep.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import transit_parser as tp
+import transit_scraper as ts
+from dv_mock_server import MockDepartureVision, clock_time
+
+
+def build_day(date, path, freq, trains=None):
+	"""Write a train file under path for every train running on date;
+	returns the number of files."""
+	midnight = datetime.strptime(date, "%Y-%m-%d")
+	ts.clock = ts.SimulatedClock(midnight + timedelta(hours=12))
+	dv = MockDepartureVision(ts.clock, trains=trains or 100000, latency=0)
+	for mock in dv.trains.values():
+		start = midnight + timedelta(seconds=mock.start)
+		ts.clock = ts.SimulatedClock(start - timedelta(minutes=ts.Train.buffers["NJ Transit"]))
+		train = ts.Train(mock.id, mock.line, clock_time(mock.start))
+		while True:
+			now = ts.clock.now()
+			seconds = int((now - midnight).total_seconds())
+			# train_stops of the stand-in's page: the status lines, then the
+			# empty cell ending the table
+			train.data.append([now, mock.status_lines(seconds) + [u""]])
+			train.scrape_count = train.scrape_count + 1
+			if seconds > mock.end:
+				break
+			ts.clock.sleep(freq)
+		with open(os.path.join(path, train.file_name()), 'w') as outfile:
+			outfile.write(train.to_json())
+	return len(dv.trains)
+
+
+def parse_day(path, day, csv_path, workers):
+	"""Parse the day with workers processes; returns (seconds, parser)."""
+	parser = tp.DayParser(path, day, csv_path=csv_path)
+	started = time.time()
+	with redirect_stdout(io.StringIO()):
+		parser.parse_all_trains(workers=workers)
+	return time.time() - started, parser
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--date', default="2018-04-10", help='day of the GTFS feed to build')
+	parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+	parser.add_argument('--freq', type=int, default=60, help='seconds between scrapes')
+	parser.add_argument('--trains', type=int, default=None,
+						help='only build this many trains (default every train of the day)')
+	parser.add_argument('--keep', default=None, help='build the day in this directory and keep it')
+	args = parser.parse_args()
+
+	root = args.keep or tempfile.mkdtemp()
+	day = datetime.strptime(args.date, "%Y-%m-%d").strftime("%Y_%m_%d")
+	directory = os.path.join(root, day)
+	os.makedirs(directory, exist_ok=True)
+	started = time.time()
+	count = build_day(args.date, directory, args.freq, args.trains)
+	print("built {} train files in {:.1f}s, {} cpus".format(count, time.time() - started,
+															 multiprocessing.cpu_count()))
+
+	print("")
+	print("{:>8} {:>9} {:>8} {:>8} {:>8} {:>6}".format(
+		"workers", "seconds", "speedup", "rows", "invalid", "same"))
+	serial = None
+	for workers in args.workers:
+		csv_path = tempfile.mkdtemp(dir=root) + '/'
+		seconds, result = parse_day(os.path.join(root, ''), day, csv_path, workers)
+		if serial is None:
+			serial = seconds, result
+		same = (result.all_trains_df.equals(serial[1].all_trains_df) and
+				[t.train for t in result.invalid_trains] == [t.train for t in serial[1].invalid_trains])
+		print("{:>8} {:>9.2f} {:>7.1f}x {:>8} {:>8} {:>6}".format(
+			workers, seconds, serial[0] / seconds, len(result.all_trains_df),
+			len(result.invalid_trains), str(same)))
+		shutil.rmtree(csv_path, ignore_errors=True)
+
+	if args.keep is None:
+		shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
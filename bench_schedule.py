@@ -0,0 +1,78 @@
+"""Time first-arrival lookups of every block_id: masking against the index.
+
+Before rail_data/schedule.py, the scraper and the parser found a train's
+schedule by boolean-masking the merged trips and stop_times tables on
+block_id. This times that lookup for every block_id in the GTFS feed
+against ScheduleIndex.first_arrival:
+
+	python bench_schedule.py --date 2018-04-10
+
+The masked tables ignore the calendar, like the index does for a date
+calendar_dates.txt does not cover, so results are compared on such a
+date; the index is also timed on --date. Run from the repository root.
+"""
+import argparse
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from rail_data.schedule import ScheduleIndex
+
+RAIL_DATA = "./rail_data/"
+# not in calendar_dates.txt, every service of a block is used
+UNCOVERED = datetime(2000, 1, 1)
+
+
+def timed(fn, *args):
+	started = time.time()
+	result = fn(*args)
+	return time.time() - started, result
+
+
+def masked_arrivals(trip_stops, block_ids):
+	arrivals = {}
+	for block_id in block_ids:
+		stops = trip_stops[trip_stops['block_id'] == block_id]['arrival_time']
+		arrivals[block_id] = stops.iloc[0] if len(stops) else None
+	return arrivals
+
+
+def indexed_arrivals(index, day, block_ids):
+	return dict((block_id, index.first_arrival(day, block_id)) for block_id in block_ids)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--date', default="2018-04-10", help='service date to time the index on')
+	args = parser.parse_args()
+	day = datetime.strptime(args.date, "%Y-%m-%d")
+
+	trips = pd.read_csv(RAIL_DATA + 'trips.txt', dtype={'block_id': str})
+	stop_times = pd.read_csv(RAIL_DATA + 'stop_times.txt')
+	calendar_dates = pd.read_csv(RAIL_DATA + 'calendar_dates.txt')
+	merge_time, trip_stops = timed(lambda: stop_times.merge(trips, on=['trip_id']))
+	block_ids = sorted(trips['block_id'].dropna().unique())
+	build_time, index = timed(ScheduleIndex, trips, stop_times, calendar_dates)
+	print("{} block_ids, {} stop_times rows".format(len(block_ids), len(trip_stops)))
+
+	mask_time, masked = timed(masked_arrivals, trip_stops, block_ids)
+	index_time, indexed = timed(indexed_arrivals, index, UNCOVERED, block_ids)
+	date_time, dated = timed(indexed_arrivals, index, day, block_ids)
+	cached_time, cached = timed(indexed_arrivals, index, day, block_ids)
+
+	print("")
+	print("{:<28} {:>10} {:>12}".format("lookup", "seconds", "us/lookup"))
+	for name, seconds in [("masking (+{:.2f}s merge)".format(merge_time), mask_time),
+						  ("index, any service", index_time),
+						  ("index, {}".format(args.date), date_time),
+						  ("index, {} again".format(args.date), cached_time)]:
+		print("{:<28} {:>10.3f} {:>12.1f}".format(name, seconds, seconds / len(block_ids) * 1e6))
+	print("index built in {:.2f}s".format(build_time))
+	print("same first arrival for every block_id: {}".format(masked == indexed))
+	print("scheduled on {}: {} of {}".format(args.date, sum(1 for a in dated.values() if a),
+											 len(block_ids)))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,177 @@
+"""Crash-safe checkpointing of TerminalScraper state.
+
+State is appended to a JSON-lines log after every scraping loop. Only
+what changed since the previous loop is written: terminal scrape times,
+train metadata, the scrape entries a train has gained, and trains that
+completed. A completed train's data stays in the log until its upload is
+logged. On startup the log is replayed to rebuild the scraper's current
+and completed trains, completed trains that were not uploaded are
+submitted again, and the log is compacted into a fresh snapshot.
+"""
+import json
+import os
+from datetime import datetime
+
+
+def parse_datetime(value):
+	if value is None:
+		return None
+	try:
+		return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+	except ValueError:
+		return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+class Checkpoint:
+	"""Append-only log of scraper state at path.
+
+	Keyword arguments:
+	path -- log file location
+	max_bytes -- compact the log into a snapshot once it grows past this
+	fsync -- fsync after every save (survives power loss, not just a crash)
+	"""
+	train_fields = ["id", "line", "dep", "created_at", "scrape_count", "type",
+					"buffer_mins", "scheduled", "t_scrape", "completed", "idle", "expired"]
+
+	def __init__(self, path='trains/checkpoint.log', max_bytes=64 * 1024 * 1024,
+				 fsync=False):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.fsync = fsync
+		self.log = None
+		# what has been written for each item, to find what changed
+		self.terminals = {}
+		self.trains = {}
+		self.completed = {}
+
+	def train_state(self, train):
+		return dict((field, getattr(train, field)) for field in self.train_fields)
+
+	def open(self):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		self.log = open(self.path, 'a')
+
+	def write(self, records):
+		for record in records:
+			self.log.write(json.dumps(record, default=str))
+			self.log.write("\n")
+		self.log.flush()
+		if self.fsync:
+			os.fsync(self.log.fileno())
+
+	def changes(self, scraper):
+		records = []
+		for name, info in scraper.terminals.items():
+			if self.terminals.get(name) != info['t_scrape']:
+				self.terminals[name] = info['t_scrape']
+				records.append({"op": "terminal", "name": name, "t_scrape": info['t_scrape']})
+
+		# completed trains waiting on the uploader are logged like current ones
+		trains = list(scraper.current_trains.items())
+		trains.extend((key, train) for key, train in list(scraper.uploading.values())
+					  if train is not None)
+		for key, train in trains:
+			num_data, t_scrape, dep = self.trains.get(key, (0, None, None))
+			if num_data < len(train.data):
+				records.append({"op": "data", "key": key, "entries": train.data[num_data:]})
+			if (num_data, t_scrape, dep) != (len(train.data), train.t_scrape, train.dep):
+				records.append({"op": "train", "key": key, "state": self.train_state(train)})
+				self.trains[key] = (len(train.data), train.t_scrape, train.dep)
+
+		if any(key not in scraper.completed_trains for key in self.completed):
+			# completed trains were reset for a new day
+			self.completed = dict((key, uploaded) for key, uploaded in self.completed.items()
+								  if key in scraper.completed_trains)
+			records.append({"op": "reset", "keys": list(self.completed)})
+		for key, record in scraper.completed_trains.items():
+			if self.completed.get(key) != record.uploaded:
+				self.completed[key] = record.uploaded
+				if record.uploaded:
+					self.trains.pop(key, None)
+				records.append({"op": "done", "key": key, "id": record.id,
+								"completed_at": record.completed_at,
+								"uploaded": record.uploaded})
+		return records
+
+	def save(self, scraper):
+		"""Append everything that changed since the last save."""
+		if self.log is None:
+			self.open()
+		records = self.changes(scraper)
+		if records:
+			self.write(records)
+		if self.log.tell() > self.max_bytes:
+			self.compact(scraper)
+
+	def compact(self, scraper):
+		"""Rewrite the log as a snapshot of the scraper's current state."""
+		if self.log is not None:
+			self.log.close()
+		self.terminals, self.trains, self.completed = {}, {}, {}
+		tmp_path = self.path + '.tmp'
+		self.log = open(tmp_path, 'w')
+		self.write(self.changes(scraper))
+		os.fsync(self.log.fileno())
+		self.log.close()
+		os.replace(tmp_path, self.path)
+		self.open()
+
+	def read(self):
+		records = []
+		if not os.path.exists(self.path):
+			return records
+		with open(self.path) as log:
+			for line in log:
+				try:
+					records.append(json.loads(line))
+				except ValueError:
+					# torn write at the end of the log
+					break
+		return records
+
+	def restore(self, scraper, train_cls, completed_cls):
+		"""Rebuild scraper state from the log; returns the number of trains."""
+		current, data, completed, unsent = {}, {}, {}, {}
+		for record in self.read():
+			op = record["op"]
+			key = record.get("key")
+			if op == "terminal":
+				if record["name"] in scraper.terminals:
+					scraper.terminals[record["name"]]['t_scrape'] = parse_datetime(record["t_scrape"])
+			elif op == "train":
+				current[key] = record["state"]
+			elif op == "data":
+				data.setdefault(key, []).extend(record["entries"])
+			elif op == "done":
+				if key in current:
+					unsent[key] = (current.pop(key), data.pop(key, []))
+				if record["uploaded"]:
+					# the data is in the bucket, it is not needed
+					unsent.pop(key, None)
+				completed[key] = record
+			elif op == "reset":
+				completed = dict((k, completed[k]) for k in record["keys"] if k in completed)
+				unsent = dict((k, unsent[k]) for k in record["keys"] if k in unsent)
+
+		for key, state in current.items():
+			scraper.current_trains[key] = self.restore_train(train_cls, state, data.get(key, []))
+		for key, record in completed.items():
+			scraper.completed_trains[key] = completed_cls(record["id"],
+														  parse_datetime(record["completed_at"]),
+														  record["uploaded"])
+		for key, (state, entries) in unsent.items():
+			print("uploading {} again".format(key))
+			scraper.upload_train(key, self.restore_train(train_cls, state, entries))
+
+		self.compact(scraper)
+		return len(scraper.current_trains)
+
+	def restore_train(self, train_cls, state, entries):
+		for field in ["created_at", "t_scrape"]:
+			state[field] = parse_datetime(state[field])
+		for entry in entries:
+			# scrape times were logged as strings
+			entry[0] = parse_datetime(entry[0])
+		return train_cls.from_state(state, entries)
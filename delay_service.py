@@ -0,0 +1,177 @@
+"""Live delays of the trains being scraped, served from memory.
+
+A DelayIndex is updated by the scraper after every train scrape with the
+train's latest page and its GTFS schedule. It keeps, per train, each
+station's status, expected or observed departure and delay, and renders
+the JSON answers when a train changes, so queries only join strings:
+
+	/delays              every active train's summary
+	/delays?line=<line>  summaries of the trains on a line
+	/train?id=<id>       one train's stop-by-stop status
+	/lines               active trains per line
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from dv_pages import clock_datetime, station_statuses
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def delay_minutes(actual, scheduled):
+	if actual is None or scheduled is None:
+		return None
+	return round((actual - scheduled).total_seconds() / 60.0, 1)
+
+
+def format_time(value):
+	return value.strftime(TIME_FORMAT) if value is not None else None
+
+
+class DelayIndex:
+	"""Latest per-station status and delay of every active train.
+
+	Keyword arguments:
+	stations -- station name -> stop_id (rail_data/rail_stations)
+	"""
+	departed_statuses = ["DEPARTED", "Cancelled"]
+	time_re = re.compile(r".*?(\d+):(\d+).*")
+
+	def __init__(self, stations):
+		self.stations = stations
+		# train id -> station -> time the station was first seen departed,
+		# None if it had already departed when the train was first indexed
+		self.departed = {}
+		# train id -> (line, summary JSON, status JSON)
+		self.trains = {}
+		# line -> set of train ids
+		self.lines = {}
+		self.lock = threading.Lock()
+
+	def stops(self, train_id, page, scheduled, now):
+		first_page = train_id not in self.departed
+		departed = self.departed.setdefault(train_id, {})
+		stops = []
+		for station, status in station_statuses(page):
+			if station not in self.stations:
+				continue
+			scheduled_at = scheduled.get(self.stations[station])
+			stop = {"station": station, "status": status.strip(),
+					"scheduled": format_time(scheduled_at)}
+			if any(x in status for x in self.departed_statuses):
+				departed_at = departed.setdefault(station, None if first_page else now)
+				stop["departed"] = format_time(departed_at)
+				if "DEPARTED" in status:
+					stop["delay_minutes"] = delay_minutes(departed_at, scheduled_at)
+			else:
+				match = self.time_re.match(status)
+				expected = None
+				if match is not None:
+					expected = clock_datetime(int(match.group(1)), int(match.group(2)), now)
+				stop["expected"] = format_time(expected)
+				stop["delay_minutes"] = delay_minutes(expected, scheduled_at)
+			stops.append(stop)
+		return stops
+
+	def update(self, train, scheduled, now):
+		"""Index train's latest page.
+
+		scheduled -- stop_id -> scheduled departure datetime for the train
+		"""
+		stops = self.stops(train.id, train.page, scheduled, now)
+		last_departed, next_stop, delay = None, None, None
+		for stop in stops:
+			if "departed" in stop:
+				last_departed = stop
+			elif next_stop is None:
+				next_stop = stop
+		for stop in [next_stop, last_departed]:
+			if stop is not None and stop.get("delay_minutes") is not None:
+				delay = stop["delay_minutes"]
+				break
+		summary = {"train": train.id, "line": train.line, "updated": format_time(now),
+				   "delay_minutes": delay,
+				   "last_departed": last_departed["station"] if last_departed else None,
+				   "next_stop": next_stop["station"] if next_stop else None,
+				   "next_expected": next_stop.get("expected") if next_stop else None}
+		status = dict(summary)
+		status["stops"] = stops
+		entry = (train.line, json.dumps(summary), json.dumps(status))
+		with self.lock:
+			previous = self.trains.get(train.id)
+			if previous is not None and previous[0] != train.line:
+				self.lines[previous[0]].discard(train.id)
+			self.trains[train.id] = entry
+			self.lines.setdefault(train.line, set()).add(train.id)
+
+	def remove(self, train_id):
+		with self.lock:
+			entry = self.trains.pop(train_id, None)
+			if entry is not None:
+				self.lines[entry[0]].discard(train_id)
+				if not self.lines[entry[0]]:
+					del self.lines[entry[0]]
+			self.departed.pop(train_id, None)
+
+	def line_delays(self, line=None):
+		with self.lock:
+			if line is None:
+				summaries = [entry[1] for entry in self.trains.values()]
+			else:
+				summaries = [self.trains[t][1] for t in self.lines.get(line, ())]
+		return '{{"line": {}, "trains": [{}]}}'.format(json.dumps(line), ", ".join(summaries))
+
+	def train_status(self, train_id):
+		"""JSON status of a train, or None if it is not being scraped."""
+		with self.lock:
+			entry = self.trains.get(train_id) or self.trains.get(train_id.zfill(4))
+		return entry[2] if entry is not None else None
+
+	def line_counts(self):
+		with self.lock:
+			return json.dumps(dict((line, len(ids)) for line, ids in self.lines.items()))
+
+	def respond(self, path, query):
+		"""Return (status, JSON body) for a request."""
+		if path == "/delays":
+			return 200, self.line_delays(query.get("line", [None])[0])
+		if path == "/train":
+			status = self.train_status(query.get("id", [""])[0])
+			if status is None:
+				return 404, '{"error": "unknown train"}'
+			return 200, status
+		if path == "/lines":
+			return 200, self.line_counts()
+		return 404, '{"error": "not found"}'
+
+	def serve(self, port, host='127.0.0.1'):
+		"""Serve queries on http://host:port/ from a daemon thread."""
+		index = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			# headers and body are written separately, don't wait for an ACK
+			disable_nagle_algorithm = True
+
+			def do_GET(self):
+				parts = urlsplit(self.path)
+				status, body = index.respond(parts.path, parse_qs(parts.query))
+				body = body.encode('utf-8')
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		server = ThreadingHTTPServer((host, port), Handler)
+		server.daemon_threads = True
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return server
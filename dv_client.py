@@ -0,0 +1,170 @@
+"""Shared HTTP client for DepartureVision (dv.njtransit.com) requests.
+
+All scraper requests go through one requests.Session so connections are
+kept alive and reused. Failed requests are retried a bounded number of
+times with jittered exponential backoff, and each endpoint has a circuit
+breaker so an outage does not tie up the scraping loop.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+	"""Raised instead of sending a request while an endpoint's circuit is open."""
+
+
+class CircuitBreaker:
+	"""Opens after threshold consecutive failures; after reset_timeout seconds
+	a single trial request is let through, which closes the circuit again if
+	it succeeds.
+	"""
+
+	def __init__(self, threshold=5, reset_timeout=60):
+		self.threshold = threshold
+		self.reset_timeout = reset_timeout
+		self.failures = 0
+		self.opened_at = None
+		self.lock = threading.Lock()
+
+	def allow(self):
+		with self.lock:
+			if self.opened_at is None:
+				return True
+			if time.time() - self.opened_at >= self.reset_timeout:
+				# half-open: let this request through, hold back the rest
+				self.opened_at = time.time()
+				return True
+			return False
+
+	def record_success(self):
+		with self.lock:
+			self.failures = 0
+			self.opened_at = None
+
+	def record_failure(self):
+		with self.lock:
+			self.failures = self.failures + 1
+			if self.failures >= self.threshold:
+				self.opened_at = time.time()
+
+
+class DVClient:
+	"""Pooled, retrying HTTP client shared by Train and TerminalScraper."""
+
+	def __init__(self, max_retries=2, backoff=0.5, max_backoff=8, pool_size=16,
+				 breaker_threshold=5, breaker_timeout=60, metrics=None):
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.breaker_threshold = breaker_threshold
+		self.breaker_timeout = breaker_timeout
+		self.breakers = {}
+		self.lock = threading.Lock()
+		self.retries = 0
+		# optional metrics.Metrics registry for latency/retry/error counts
+		self.metrics = metrics
+
+		self.session = requests.Session()
+		self.pool_size = 0
+		self.adapter = None
+		self.ensure_pool_size(pool_size)
+
+	def ensure_pool_size(self, pool_size):
+		"""Keep at least pool_size connections per host, one for each thread
+		that may send requests at once; a full pool discards connections."""
+		with self.lock:
+			if pool_size <= self.pool_size:
+				return
+			old = self.adapter
+			self.pool_size = pool_size
+			self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+									   max_retries=0)
+			self.session.mount('http://', self.adapter)
+			self.session.mount('https://', self.adapter)
+		if old is not None:
+			old.close()
+
+	def endpoint(self, url):
+		parts = urlsplit(url)
+		return parts.netloc + parts.path
+
+	def breaker(self, endpoint):
+		with self.lock:
+			if endpoint not in self.breakers:
+				self.breakers[endpoint] = CircuitBreaker(self.breaker_threshold,
+														 self.breaker_timeout)
+			return self.breakers[endpoint]
+
+	def backoff_delay(self, attempt):
+		# "full jitter": uniform over [0, capped exponential]
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+	def get(self, url, timeout=3, retries=None):
+		"""GET url, retrying connection errors and 5xx responses.
+
+		Returns the final response (which may still be a 5xx) or raises a
+		requests RequestException once the retries are used up. Raises
+		CircuitOpenError without sending anything if the endpoint's circuit
+		is open.
+		"""
+		if retries is None:
+			retries = self.max_retries
+		endpoint = self.endpoint(url)
+		breaker = self.breaker(endpoint)
+
+		attempt = 0
+		while True:
+			if not breaker.allow():
+				self.record(endpoint, "circuit_open")
+				raise CircuitOpenError("circuit open for {}".format(endpoint))
+			start = time.time()
+			try:
+				resp = self.session.get(url, timeout=timeout)
+			except requests.exceptions.RequestException:
+				self.record(endpoint, "error", time.time() - start)
+				breaker.record_failure()
+				if attempt >= retries:
+					raise
+			else:
+				self.record(endpoint, str(resp.status_code), time.time() - start)
+				if resp.status_code < 500:
+					breaker.record_success()
+					return resp
+				breaker.record_failure()
+				if attempt >= retries:
+					return resp
+			time.sleep(self.backoff_delay(attempt))
+			attempt = attempt + 1
+			with self.lock:
+				self.retries = self.retries + 1
+			if self.metrics is not None:
+				self.metrics.counter("dv_retries_total", "Retried DepartureVision requests",
+									 endpoint=endpoint).inc()
+
+	def record(self, endpoint, outcome, seconds=None):
+		if self.metrics is None:
+			return
+		self.metrics.counter("dv_requests_total", "DepartureVision requests by outcome",
+							 endpoint=endpoint, outcome=outcome).inc()
+		if seconds is not None:
+			self.metrics.histogram("dv_request_seconds", "DepartureVision request latency",
+								   endpoint=endpoint).observe(seconds)
+
+	def stats(self):
+		"""Request and connection counts summed over the live connection pools."""
+		num_requests, num_connections = 0, 0
+		pools = self.adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is not None:
+				num_requests = num_requests + pool.num_requests
+				num_connections = num_connections + pool.num_connections
+		return {"requests": num_requests,
+				"connections": num_connections,
+				"reused": num_requests - num_connections,
+				"retries": self.retries}
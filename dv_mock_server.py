@@ -0,0 +1,225 @@
+"""Local stand-in for the DepartureVision mobile site.
+
+Serves /mobile/tid-mobile.aspx?sid=<abbrev> (terminal boards) and
+/mobile/train_stops.aspx?train=<id> (train status pages) with pages built
+from the GTFS files in rail_data/, in the same layout the scraper parses.
+The server follows a transit_scraper Clock, normally an OffsetClock
+started at a moment covered by the GTFS calendar, so the scraper and the
+server agree on the time. Latency, error rate and the number of trains
+running can be configured, and every request is counted.
+
+Run standalone with:
+	python dv_mock_server.py --port 8008 --start "2018-04-10 08:00" --trains 200
+"""
+import argparse
+import csv
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from rail_data.schedule import get_schedule, seconds_after_midnight
+from transit_scraper import TERMINALS, TERMINAL_STATIONS, ALL_STATIONS, RAIL_DATA, \
+	OffsetClock
+
+
+def clock_time(seconds):
+	hour, minute = (seconds // 3600) % 24, (seconds // 60) % 60
+	return "{}:{:02d}".format(hour % 12 or 12, minute)
+
+
+class MockTrain:
+	"""A train's stops as (station, seconds after midnight) on the mock clock."""
+
+	def __init__(self, train_id, line, stops, delay=0, stale=False):
+		self.id = train_id
+		self.line = line
+		self.stops = [(station, seconds + delay) for station, seconds in stops]
+		self.start = self.stops[0][1]
+		self.end = self.stops[-1][1]
+		# the final stop never shows DEPARTED, so the train never completes
+		self.stale = stale
+
+	def status_lines(self, now):
+		lines = []
+		for i, (station, seconds) in enumerate(self.stops):
+			if seconds <= now and not (self.stale and i == len(self.stops) - 1):
+				lines.append(u"{}\xa0\xa0DEPARTED".format(station))
+			else:
+				lines.append(u"{}\xa0\xa0at {}".format(station, clock_time(seconds)))
+		return lines
+
+
+class MockDepartureVision:
+	"""Trains and pages for the service date of clock.now().
+
+	Keyword arguments:
+	clock -- transit_scraper Clock shared with the scraper under test
+	trains -- number of trains to run; those whose journeys are nearest the
+			  current time are picked
+	latency -- mean response delay in seconds (uniform +/- 50%)
+	error_rate -- fraction of requests answered with a 500
+	stale_rate -- fraction of trains whose final stop never shows DEPARTED
+	max_delay -- trains run up to this many minutes late
+	board_size -- departures listed per terminal board
+	"""
+
+	def __init__(self, clock, trains=200, latency=0.05, error_rate=0.0,
+				 stale_rate=0.0, max_delay=5, board_size=19, seed=0):
+		self.clock = clock
+		self.date = clock.now()
+		self.latency = latency
+		self.error_rate = error_rate
+		self.board_size = board_size
+		self.stale_rate = stale_rate
+		self.random = random.Random(seed)
+		self.counts = {}
+		self.lock = threading.Lock()
+
+		self.station_names = dict((stop_id, name) for name, stop_id in ALL_STATIONS.items()
+								  if stop_id is not None)
+		self.terminal_stops = {}
+		for name, info in TERMINALS.items():
+			stop_id = ALL_STATIONS.get(TERMINAL_STATIONS.get(name, name))
+			if stop_id is not None:
+				self.terminal_stops[info['abbrev']] = stop_id
+
+		now = self.seconds_now()
+		candidates = self.load_trains(max_delay)
+		candidates.sort(key=lambda t: abs((t.start + t.end) / 2 - now))
+		self.trains = dict((t.id, t) for t in candidates[:trains])
+
+	def load_trains(self, max_delay):
+		lines = {}
+		routes = dict((r['route_id'], r['route_long_name'])
+					  for r in csv.DictReader(open(RAIL_DATA + 'routes.txt')))
+		for trip in csv.DictReader(open(RAIL_DATA + 'trips.txt')):
+			lines[trip['block_id']] = routes.get(trip['route_id'], "")
+
+		schedule = get_schedule(RAIL_DATA)
+		trains = []
+		for block_id in schedule.blocks:
+			stops = []
+			for arrival, stop_id, sequence in schedule.get(self.date, block_id):
+				if stop_id in self.station_names:
+					stops.append((self.station_names[stop_id], seconds_after_midnight(arrival)))
+			if stops and block_id.isdigit():
+				delay = self.random.randint(0, max_delay) * 60
+				stale = self.random.random() < self.stale_rate
+				trains.append(MockTrain(block_id, lines.get(block_id, ""), stops, delay, stale))
+		return trains
+
+	def seconds_now(self):
+		now = self.clock.now()
+		return now.hour * 3600 + now.minute * 60 + now.second
+
+	def count(self, endpoint):
+		with self.lock:
+			self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+	def train_page(self, train_id):
+		train = self.trains.get(train_id.lstrip("0")) or self.trains.get(train_id)
+		if train is None:
+			return "<html><body><p>No data for train {}</p></body></html>".format(train_id)
+		rows = "".join(u"<tr><td><p>{}</p></td></tr>\r\n".format(line)
+					   for line in train.status_lines(self.seconds_now()))
+		return (u"<html><body><div>Train {}</div><table>\r\n{}<tr><td></td></tr></table>"
+				u"</body></html>".format(train.id, rows))
+
+	def board(self, abbrev):
+		stop_id = self.terminal_stops.get(abbrev)
+		if stop_id is None:
+			return []
+		station = self.station_names[stop_id]
+		now = self.seconds_now()
+		departures = []
+		for train in self.trains.values():
+			for name, seconds in train.stops[:-1]:
+				if name == station and seconds > now:
+					departures.append((seconds, train))
+		departures.sort(key=lambda d: d[0])
+		return departures[:self.board_size]
+
+	def terminal_page(self, abbrev):
+		rows = []
+		for seconds, train in self.board(abbrev):
+			cells = [clock_time(seconds), train.stops[-1][0], str(self.random.randint(1, 5)),
+					 train.line, train.id, ""]
+			inner = "".join("<td>{}</td>".format(cell) for cell in cells)
+			rows.append("<tr><td><table><tr>{}</tr></table></td></tr>\r\n".format(inner))
+		return (u"<html><body><table><tr><th>Departures</th></tr>\r\n{}</table>"
+				u"</body></html>".format("".join(rows)))
+
+	def respond(self, path, query):
+		"""Return (status, body) for a request, after the simulated latency."""
+		if self.latency:
+			time.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+		endpoint = path.rsplit("/", 1)[-1]
+		self.count(endpoint)
+		if self.random.random() < self.error_rate:
+			return 500, "<html><body>Server Error</body></html>"
+		if endpoint == "tid-mobile.aspx":
+			return 200, self.terminal_page(query.get("sid", [""])[0])
+		if endpoint == "train_stops.aspx":
+			return 200, self.train_page(query.get("train", [""])[0])
+		return 404, "<html><body>Not Found</body></html>"
+
+
+def serve(dv, port=0, host='127.0.0.1'):
+	"""Serve dv from a daemon thread; returns the server (see server_port)."""
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+		# headers and body are written separately, don't wait for an ACK
+		disable_nagle_algorithm = True
+
+		def do_GET(self):
+			parts = urlsplit(self.path)
+			status, body = dv.respond(parts.path, parse_qs(parts.query))
+			body = body.encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'text/html; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer((host, port), Handler)
+	server.daemon_threads = True
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--port', type=int, default=8008)
+	parser.add_argument('--start', default='2018-04-10 08:00',
+						help='simulated start time, within the GTFS calendar')
+	parser.add_argument('--trains', type=int, default=200)
+	parser.add_argument('--latency', type=float, default=0.05)
+	parser.add_argument('--error-rate', type=float, default=0.0)
+	parser.add_argument('--stale-rate', type=float, default=0.0)
+	args = parser.parse_args()
+
+	clock = OffsetClock(datetime.strptime(args.start, "%Y-%m-%d %H:%M"))
+	dv = MockDepartureVision(clock, trains=args.trains, latency=args.latency,
+							 error_rate=args.error_rate, stale_rate=args.stale_rate)
+	server = serve(dv, args.port)
+	print("serving {} trains on http://127.0.0.1:{}/mobile/".format(len(dv.trains),
+																	 server.server_port))
+	try:
+		while True:
+			time.sleep(60)
+			print(dv.counts)
+	except KeyboardInterrupt:
+		server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,197 @@
+"""Targeted extraction of table cells from DepartureVision pages.
+
+Building a full BeautifulSoup tree for every scrape dominates the
+scraper's CPU time, while all it needs are the text of the <td> cells in
+one or two kinds of table. TableExtractor makes a single streaming pass
+with the standard library HTMLParser and records, for every cell, its
+text (including the text of nested elements, like Tag.text) and the
+tables it sits in. Unlike Tag.text in newer BeautifulSoup releases, the
+text of <script> and <style> elements inside a cell is kept.
+"""
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+
+VOID_ELEMENTS = frozenset(["area", "base", "br", "col", "embed", "hr", "img",
+						   "input", "keygen", "link", "meta", "param", "source",
+						   "track", "wbr"])
+CELLS = ("td", "th")
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+
+class TableExtractor(HTMLParser):
+	"""Collects every <td> of a page along with its enclosing tables.
+
+	After feeding a page:
+	tables -- list of (table_id, parent_tag) in document order
+	cells -- list of [text, table_ids] for every <td> in document order,
+			 where table_ids are the ids of all tables enclosing the cell
+	"""
+
+	def __init__(self):
+		HTMLParser.__init__(self, convert_charrefs=True)
+		self.tables = []
+		self.cells = []
+		# open elements as [tag, table_id or cell record or None]
+		self.stack = []
+		self.open_tables = []
+		self.open_cells = []
+
+	def pop_to(self, idx):
+		while len(self.stack) > idx:
+			tag, item = self.stack.pop()
+			if tag == "table":
+				self.open_tables.pop()
+			elif tag == "td":
+				self.open_cells.pop()
+
+	def find_open(self, tags, stop=("table",)):
+		"""Index of the innermost open element in tags, not looking past stop."""
+		for idx in range(len(self.stack) - 1, -1, -1):
+			tag = self.stack[idx][0]
+			if tag in tags:
+				return idx
+			if tag in stop:
+				return -1
+		return -1
+
+	def handle_starttag(self, tag, attrs):
+		if tag in VOID_ELEMENTS:
+			return
+		# cells and rows are closed implicitly by the next cell or row
+		if tag in CELLS:
+			idx = self.find_open(CELLS, stop=("table", "tr"))
+			if idx >= 0:
+				self.pop_to(idx)
+		elif tag == "tr":
+			idx = self.find_open(("tr",) + CELLS)
+			if idx >= 0:
+				row = self.find_open(("tr",))
+				self.pop_to(row if row >= 0 else idx)
+
+		if tag == "table":
+			table_id = len(self.tables)
+			parent = self.stack[-1][0] if self.stack else None
+			self.tables.append((table_id, parent))
+			self.open_tables.append(table_id)
+			self.stack.append([tag, table_id])
+		elif tag == "td":
+			cell = [[], list(self.open_tables)]
+			self.cells.append(cell)
+			self.open_cells.append(cell)
+			self.stack.append([tag, cell])
+		else:
+			self.stack.append([tag, None])
+
+	def handle_startendtag(self, tag, attrs):
+		self.handle_starttag(tag, attrs)
+		if tag not in VOID_ELEMENTS:
+			self.handle_endtag(tag)
+
+	def handle_endtag(self, tag):
+		for idx in range(len(self.stack) - 1, -1, -1):
+			if self.stack[idx][0] == tag:
+				self.pop_to(idx)
+				return
+
+	def handle_data(self, data):
+		if not self.open_cells:
+			return
+		# BeautifulSoup collapses whitespace-only strings the same way
+		if not data.strip(ASCII_SPACES):
+			data = "\n" if "\n" in data else " "
+		for cell in self.open_cells:
+			cell[0].append(data)
+
+	def extract(self, html):
+		# lxml normalizes line endings before BeautifulSoup sees the text
+		self.feed(html.replace("\r\n", "\n").replace("\r", "\n"))
+		self.close()
+		for cell in self.cells:
+			cell[0] = "".join(cell[0])
+		return self
+
+
+def train_stops(html):
+	"""Text of every cell in the first table of a train_stops.aspx page.
+
+	Equivalent to [td.text for td in soup.find('table').find_all('td')],
+	and [] if the page has no table.
+	"""
+	page = TableExtractor().extract(html)
+	if not page.tables:
+		return []
+	first = page.tables[0][0]
+	return [text for text, tables in page.cells if first in tables]
+
+
+def departure_rows(html):
+	"""Cell texts of each departure row of a tid-mobile.aspx page.
+
+	Every table nested directly in a <td> is one departure; this returns
+	a list of the cell texts for each, equivalent to
+	[[td.text for td in t.find_all('td')] for t in soup.find_all('table')
+	 if t.parent.name == 'td'].
+	"""
+	page = TableExtractor().extract(html)
+	rows = dict((table_id, []) for table_id, parent in page.tables if parent == "td")
+	for text, tables in page.cells:
+		for table_id in tables:
+			if table_id in rows:
+				rows[table_id].append(text)
+	return [rows[table_id] for table_id, parent in page.tables if table_id in rows]
+
+
+def station_statuses(page):
+	"""(station, status) for each "station\xa0\xa0status" line of a train page."""
+	for line in page:
+		try:
+			station, status = line.split(u"\xa0\xa0")
+		except ValueError:
+			continue
+		yield station, status
+
+
+def clock_datetime(hour, minute, now):
+	"""The datetime nearest to now showing hour:minute on a 12h clock."""
+	base = datetime(year=now.year, month=now.month, day=now.day,
+					hour=hour % 12, minute=minute)
+	candidates = [base + timedelta(hours=h) for h in [-12, 0, 12, 24]]
+	return min(candidates, key=lambda t: abs((t - now).total_seconds()))
+
+
+################################################################################
+# DELTA ENCODING
+#
+# A train's status page rarely changes between scrapes. With delta encoding
+# Train.data keeps the first page in full as [time, page] and every later
+# scrape as [time, changes, length], where changes lists [idx, line] for the
+# lines that differ from the previous page and length is the new page length.
+################################################################################
+
+def page_delta(prev, page):
+	"""Return [[idx, line], ...] for the lines of page that differ from prev."""
+	num_prev = len(prev)
+	return [[idx, line] for idx, line in enumerate(page)
+			if idx >= num_prev or prev[idx] != line]
+
+
+def apply_delta(prev, changes, length):
+	"""Rebuild a full page from the previous page and a page_delta."""
+	page = prev[:length]
+	page.extend([""] * (length - len(page)))
+	for idx, line in changes:
+		page[idx] = line
+	return page
+
+
+def decode_pages(data):
+	"""Expand delta-encoded train data into full [time, page] entries."""
+	pages = []
+	page = []
+	for entry in data:
+		if len(entry) == 3:
+			page = apply_delta(page, entry[1], entry[2])
+		else:
+			page = entry[1]
+		pages.append([entry[0], page])
+	return pages
@@ -0,0 +1,148 @@
+"""Lightweight scraper metrics in the Prometheus text format.
+
+Counters, gauges and fixed-bucket histograms cost a lock and, for
+histograms, a bisect per observation, so they are cheap enough to leave
+on. A Metrics registry renders them as text, which can be written to a
+file or served over HTTP for a local Prometheus (or curl) to read.
+"""
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10]
+LAG_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+
+def format_labels(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+class Counter:
+	def __init__(self):
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value = self.value + amount
+
+	def samples(self, name, labels):
+		return [(name + format_labels(labels), self.value)]
+
+
+class Gauge:
+	"""Either set explicitly or read from fn when rendered."""
+
+	def __init__(self, fn=None):
+		self.value = 0
+		self.fn = fn
+
+	def set(self, value):
+		self.value = value
+
+	def samples(self, name, labels):
+		value = self.fn() if self.fn is not None else self.value
+		return [(name + format_labels(labels), value)]
+
+
+class Histogram:
+	def __init__(self, buckets):
+		self.buckets = sorted(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		idx = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[idx] = self.counts[idx] + 1
+			self.sum = self.sum + value
+
+	def samples(self, name, labels):
+		with self.lock:
+			counts, total = list(self.counts), self.sum
+		samples = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + ["+Inf"], counts):
+			cumulative = cumulative + count
+			bucket_labels = list(labels) + [("le", bound)]
+			samples.append((name + "_bucket" + format_labels(bucket_labels), cumulative))
+		samples.append((name + "_sum" + format_labels(labels), total))
+		samples.append((name + "_count" + format_labels(labels), cumulative))
+		return samples
+
+
+class Metrics:
+	"""Registry of named metrics, each with any number of label sets."""
+
+	def __init__(self):
+		# name -> [type, help, {labels: metric}]
+		self.metrics = {}
+		self.lock = threading.Lock()
+
+	def get(self, kind, name, help_text, labels, factory):
+		labels = tuple(sorted(labels.items()))
+		with self.lock:
+			if name not in self.metrics:
+				self.metrics[name] = [kind, help_text, {}]
+			series = self.metrics[name][2]
+			if labels not in series:
+				series[labels] = factory()
+			return series[labels]
+
+	def counter(self, name, help_text, **labels):
+		return self.get("counter", name, help_text, labels, Counter)
+
+	def gauge(self, name, help_text, fn=None, **labels):
+		gauge = self.get("gauge", name, help_text, labels, Gauge)
+		if fn is not None:
+			gauge.fn = fn
+		return gauge
+
+	def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+		return self.get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+	def render(self):
+		lines = []
+		with self.lock:
+			metrics = sorted((name, kind, help_text, list(series.items()))
+							 for name, (kind, help_text, series) in self.metrics.items())
+		for name, kind, help_text, series in metrics:
+			lines.append("# HELP {} {}".format(name, help_text))
+			lines.append("# TYPE {} {}".format(name, kind))
+			for labels, metric in series:
+				for sample, value in metric.samples(name, labels):
+					lines.append("{} {}".format(sample, value))
+		return "\n".join(lines) + "\n"
+
+	def write(self, path):
+		"""Write the rendered metrics to path atomically."""
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'w') as outfile:
+			outfile.write(self.render())
+		os.replace(tmp_path, path)
+
+	def serve(self, port, host='127.0.0.1'):
+		"""Serve the metrics at http://host:port/metrics from a daemon thread."""
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		server = HTTPServer((host, port), Handler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return server
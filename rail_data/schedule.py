@@ -0,0 +1,194 @@
+"""Indexed GTFS schedule lookups shared by the scraper and the parser.
+
+The trips, stop_times and calendar_dates tables are read once and folded
+into plain dicts, so looking up the stops for a train on a given service
+date does not require scanning the merged stop_times table.
+
+The index is built lazily on first use (get_schedule) and pickled next to
+the GTFS files, so later processes load it without reading the CSVs or
+importing pandas. The cache is rebuilt whenever a GTFS file's modification
+time or size changes.
+"""
+import os
+import pickle
+from datetime import timedelta
+
+RAIL_DATA = os.path.dirname(os.path.abspath(__file__)) + '/'
+GTFS_FILES = ['trips.txt', 'stop_times.txt', 'calendar_dates.txt']
+CACHE_FILE = '.schedule_cache.pickle'
+
+# path -> loaded ScheduleIndex
+SCHEDULES = {}
+
+
+def gtfs_mtimes(path):
+	return [(os.path.getmtime(path + f), os.path.getsize(path + f)) for f in GTFS_FILES]
+
+
+def load_schedule(path=RAIL_DATA):
+	"""Load the ScheduleIndex for path from its cache, rebuilding it if stale."""
+	cache_path = path + CACHE_FILE
+	try:
+		with open(cache_path, 'rb') as cache:
+			index = pickle.load(cache)
+		if not index.stale():
+			return index
+	except Exception:
+		# missing, unreadable or from an incompatible version
+		pass
+
+	index = ScheduleIndex.from_gtfs(path)
+	try:
+		tmp_path = cache_path + '.tmp'
+		with open(tmp_path, 'wb') as cache:
+			pickle.dump(index, cache, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, cache_path)
+	except (IOError, OSError):
+		print("could not write schedule cache {}".format(cache_path))
+	return index
+
+
+def get_schedule(path=RAIL_DATA):
+	"""Return the shared ScheduleIndex for path, loading it on first use."""
+	if path not in SCHEDULES:
+		SCHEDULES[path] = load_schedule(path)
+	return SCHEDULES[path]
+
+
+def reload_schedule(path=RAIL_DATA):
+	SCHEDULES[path] = load_schedule(path)
+	return SCHEDULES[path]
+
+
+def seconds_after_midnight(gtfs_time):
+	hours, minutes, seconds = gtfs_time.split(":")
+	return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def service_key(day):
+	"""Format a date/datetime the way calendar_dates.txt does ('YYYYMMDD')."""
+	return day.strftime("%Y%m%d")
+
+
+class ScheduleIndex:
+	"""Maps (service date, block_id) to the ordered list of scheduled stops.
+
+	Each stop is an (arrival_time, stop_id, stop_sequence) tuple, where
+	arrival_time is the raw GTFS string and may have an hour of 24 or more
+	for trains running past midnight.
+	"""
+
+	# service date the lookups are memoized for; a class attribute so
+	# indexes pickled before it existed still load
+	lookups_day = None
+
+	def __init__(self, trips, stop_times, calendar_dates):
+		trip_stops = stop_times.merge(trips, on=['trip_id'])
+		# set by from_gtfs, so a changed feed can be detected
+		self.path = None
+		self.mtimes = None
+
+		# block_id -> service_id -> stops, services in order of appearance
+		self.blocks = {}
+		columns = ['block_id', 'service_id', 'arrival_time', 'stop_id', 'stop_sequence']
+		for block_id, service_id, arrival, stop_id, sequence in \
+				zip(*[trip_stops[c].tolist() for c in columns]):
+			services = self.blocks.setdefault(str(block_id), {})
+			if service_id not in services:
+				services[service_id] = []
+			services[service_id].append((arrival, int(stop_id), int(sequence)))
+		self.service_order = {}
+		for block_id, services in self.blocks.items():
+			self.service_order[block_id] = list(services)
+
+		# 'YYYYMMDD' -> set of active service_ids
+		self.services = {}
+		active = calendar_dates[calendar_dates['exception_type'] == 1]
+		for service_id, date in zip(active['service_id'].tolist(), active['date'].tolist()):
+			self.services.setdefault(str(date), set()).add(service_id)
+
+		# service_id -> stop_id -> departure times (seconds after midnight),
+		# leaving out each trip's final stop
+		self.departures = {}
+		last_stop = trip_stops.groupby('trip_id')['stop_sequence'].transform('max')
+		departing = trip_stops[trip_stops['stop_sequence'] < last_stop]
+		for service_id, stop_id, departure in zip(departing['service_id'].tolist(),
+												  departing['stop_id'].tolist(),
+												  departing['departure_time'].tolist()):
+			stops = self.departures.setdefault(service_id, {})
+			stops.setdefault(int(stop_id), []).append(seconds_after_midnight(departure))
+
+		self.lookups = {}
+
+	@classmethod
+	def from_gtfs(cls, path=RAIL_DATA):
+		import pandas as pd
+		trips = pd.read_csv(path + 'trips.txt', dtype={'block_id': str})
+		stop_times = pd.read_csv(path + 'stop_times.txt')
+		calendar_dates = pd.read_csv(path + 'calendar_dates.txt')
+		index = cls(trips, stop_times, calendar_dates)
+		index.path = path
+		index.mtimes = gtfs_mtimes(path)
+		return index
+
+	def stale(self):
+		"""True if the GTFS files changed since this index was built."""
+		return self.path is not None and gtfs_mtimes(self.path) != self.mtimes
+
+	def active_services(self, day):
+		"""Service ids running on day, or None if day is outside the calendar."""
+		return self.services.get(service_key(day))
+
+	def get(self, day, block_id):
+		"""Return the scheduled stops of block_id on day ([] if not scheduled).
+
+		If day is not covered by calendar_dates.txt at all (e.g. the GTFS
+		feed is out of date), every service of the block is returned.
+		"""
+		# memoized for the most recent service date only, the scraper asks
+		# about one day at a time and would otherwise keep every day's
+		# lookups for as long as it runs
+		day_key = service_key(day)
+		if day_key != self.lookups_day:
+			self.lookups = {}
+			self.lookups_day = day_key
+		try:
+			return self.lookups[block_id]
+		except KeyError:
+			pass
+
+		stops = []
+		services = self.blocks.get(block_id)
+		if services is not None:
+			active = self.active_services(day)
+			for service_id in self.service_order[block_id]:
+				if active is None or service_id in active:
+					stops.extend(services[service_id])
+		self.lookups[block_id] = stops
+		return stops
+
+	def first_arrival(self, day, block_id):
+		"""Return the first scheduled arrival_time string, or None."""
+		stops = self.get(day, block_id)
+		if not stops:
+			return None
+		return stops[0][0]
+
+	def stop_departures(self, day, stop_id):
+		"""Sorted departure times from stop_id on day, in seconds after midnight.
+
+		Trains of the previous service day still running after midnight are
+		included (their GTFS times are 24:00:00 or later).
+		"""
+		times = []
+		previous = day - timedelta(days=1)
+		for service_day, offset in [(day, 0), (previous, -86400)]:
+			active = self.active_services(service_day)
+			for service_id, stops in self.departures.items():
+				if active is not None and service_id not in active:
+					continue
+				for seconds in stops.get(stop_id, []):
+					if seconds + offset >= 0:
+						times.append(seconds + offset)
+		times.sort()
+		return times
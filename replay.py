@@ -0,0 +1,254 @@
+"""Replay recorded train files through the scraper's scheduling logic.
+
+The real Train and TerminalScraper run on a SimulatedClock, so a day
+replays in seconds. Instead of requesting DepartureVision, a train is
+answered with the recorded page that was current at the simulated time,
+and a terminal board lists the recorded trains that stop there and have
+not yet left it. Each policy's completed trains go through TrainParser
+and are compared with the parse of the recording itself.
+
+	python replay.py scraped_data/2018_04_10/ --policies fixed-60 schedule
+
+Output, per policy: train and terminal requests, and the error of the
+parsed departure times against the recording (which was itself scraped
+every freq seconds, so it is only as exact as that).
+"""
+import argparse
+import bisect
+import io
+import json
+import os
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import dv_pages
+import transit_scraper as ts
+from checkpoint import parse_datetime
+from transit_parser import TrainParser
+from uploader import TrainUploader
+
+POLICIES = {
+	"fixed-60": {"cadence": ts.FixedCadence(), "freq": 60},
+	"fixed-120": {"cadence": ts.FixedCadence(), "freq": 120},
+	"fixed-300": {"cadence": ts.FixedCadence(), "freq": 300},
+	"schedule": {"cadence": ts.ScheduleCadence()},
+	"schedule-polling": {"cadence": ts.ScheduleCadence(), "polling": True},
+	"no-buffer": {"cadence": ts.FixedCadence(), "freq": 60,
+				  "buffers": {"NJ Transit": 0, "Amtrak": 0}},
+	"budget-0.5": {"cadence": ts.FixedCadence(), "freq": 60, "budget": 0.5},
+	"budget-0.5-priority": {"cadence": ts.FixedCadence(), "freq": 60, "budget": 0.5,
+							"priority": ts.TrainPriority()},
+}
+# policy keys configuring the scraper rather than Train
+SCRAPER_KEYS = ["polling", "budget", "priority"]
+
+# station name -> terminal abbrev
+TERMINAL_ABBREVS = dict((ts.TERMINAL_STATIONS.get(name, name), info['abbrev'])
+						for name, info in ts.TERMINALS.items())
+
+
+class RecordedTrain:
+	"""A recorded train's pages, and the boards it was listed on."""
+
+	def __init__(self, data):
+		self.id = data['id']
+		self.line = data['line']
+		self.created_at = parse_datetime(data['created_at'])
+		self.times = [parse_datetime(t) for t, page in data['data']]
+		self.pages = [page for t, page in data['data']]
+		# boards show the id without the zero padding Train adds
+		self.board_id = self.id.lstrip("0") if self.id.isdigit() else self.id
+
+	def page(self, now):
+		idx = bisect.bisect_right(self.times, now) - 1
+		return self.pages[max(idx, 0)]
+
+	def boards(self):
+		"""(abbrev, row, listed until) for each terminal the train stops at."""
+		boards = []
+		for station, status in dv_pages.station_statuses(self.pages[0]):
+			abbrev = TERMINAL_ABBREVS.get(station)
+			if abbrev is None:
+				continue
+			match = ts.Train.time_re.match(status)
+			dep = "{}:{}".format(match.group(1), match.group(2)) if match is not None else ""
+			left = self.times[-1]
+			for t, page in zip(self.times, self.pages):
+				if any(s == station and any(x in status for x in ts.Train.statuses)
+					   for s, status in dv_pages.station_statuses(page)):
+					left = t
+					break
+			row = {'train_id': self.board_id, 'line': self.line, 'dep': dep}
+			boards.append((abbrev, row, left))
+		return boards
+
+
+class Recording:
+	"""Recorded trains of a day, answering requests on the simulated clock."""
+
+	def __init__(self, trains):
+		self.trains = dict((train.id, train) for train in trains)
+		# abbrev -> [(listed from, listed until, row)]
+		self.boards = {}
+		for train in trains:
+			for abbrev, row, left in train.boards():
+				self.boards.setdefault(abbrev, []).append((train.created_at, left, row))
+		self.requests = {ts.TRAIN: 0, ts.TERMINAL: 0}
+		self.lock = threading.Lock()
+
+	@classmethod
+	def load(cls, path):
+		trains = []
+		for filename in sorted(os.listdir(path)):
+			if filename.startswith("."):
+				continue
+			data = TrainParser(path + filename).data
+			if data['data']:
+				trains.append(RecordedTrain(data))
+		return cls(trains)
+
+	def start(self):
+		return min(train.created_at for train in self.trains.values())
+
+	def end(self):
+		return max(train.times[-1] for train in self.trains.values())
+
+	def count(self, kind):
+		with self.lock:
+			self.requests[kind] = self.requests[kind] + 1
+
+	def train_page(self, train_id, now):
+		self.count(ts.TRAIN)
+		train = self.trains.get(train_id)
+		if train is None:
+			return []
+		return train.page(now)
+
+	def board(self, abbrev, now):
+		self.count(ts.TERMINAL)
+		return [row for listed, left, row in self.boards.get(abbrev, [])
+				if listed <= now < left]
+
+
+class ReplayTrain(ts.Train):
+	__slots__ = ()
+	recording = None
+
+	def request(self, timeout=3, retry=False):
+		return self.recording.train_page(self.id, ts.clock.now())
+
+
+class ReplayScraper(ts.TerminalScraper):
+	recording = None
+
+	def get_departures(self, abbrev):
+		return self.recording.board(abbrev, ts.clock.now())
+
+
+class MemoryBackend:
+	"""TrainUploader backend keeping uploaded files in a dict."""
+
+	def __init__(self):
+		self.files = {}
+
+	def put(self, key, body, compressed=False):
+		self.files[key] = body
+
+
+def replay(recording, policy, margin=3600):
+	"""Run the scraper over the recording; returns (requests, uploaded files)."""
+	attributes = dict((k, v) for k, v in policy.items() if k not in SCRAPER_KEYS)
+	attributes["__slots__"] = ()
+	attributes["recording"] = recording
+	train_class = type("PolicyTrain", (ReplayTrain,), attributes)
+	scraper_class = type("PolicyScraper", (ReplayScraper,),
+						 {"recording": recording, "train_class": train_class})
+
+	recording.requests = {ts.TRAIN: 0, ts.TERMINAL: 0}
+	ts.clock = ts.SimulatedClock(recording.start() - timedelta(seconds=margin))
+	end = recording.end() + timedelta(seconds=margin)
+	backend = MemoryBackend()
+	# the whole day may complete faster than one worker drains the queue
+	uploader = TrainUploader(backend, workers=1, max_queue=0, compress=False)
+	polling = ts.TerminalPolling(ts.TERMINALS) if policy.get("polling") else None
+	budget = ts.TokenBucket(policy["budget"]) if "budget" in policy else None
+
+	# the scraper prints every completed train
+	with redirect_stdout(io.StringIO()):
+		scraper = scraper_class(max_workers=1, uploader=uploader, polling=polling,
+								budget=budget, priority=policy.get("priority"))
+		while ts.clock.now() < end:
+			scraper.step()
+			scraper.wait()
+		for train_id in list(scraper.current_trains):
+			scraper.complete_train(train_id)
+		uploader.close()
+	return dict(recording.requests), backend.files
+
+
+def departure_times(parser):
+	"""station -> parsed departure datetime, {} if the train does not parse."""
+	if not parser.data['data'] or parser.check_file_empty():
+		return {}
+	parser.get_stop_times()
+	return dict((row['to'], datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S"))
+				for row in parser.get_rows())
+
+
+def timestamp_errors(path, files):
+	"""Absolute errors in seconds of the replayed departures, and how many
+	recorded departures the replay did not produce."""
+	replayed = {}
+	for key, body in files.items():
+		data = json.loads(body)
+		replayed[data['id']] = departure_times(TrainParser(key, data=data))
+
+	errors, missing = [], 0
+	for filename in sorted(os.listdir(path)):
+		if filename.startswith("."):
+			continue
+		truth = TrainParser(path + filename)
+		expected = departure_times(truth)
+		times = replayed.get(truth.train, {})
+		for station, departed in expected.items():
+			if station in times:
+				errors.append(abs((times[station] - departed).total_seconds()))
+			else:
+				missing = missing + 1
+	return errors, missing
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('path', help='directory of recorded train files for one day')
+	parser.add_argument('--policies', nargs='+', default=sorted(POLICIES),
+						choices=sorted(POLICIES))
+	args = parser.parse_args()
+	path = os.path.join(args.path, '')
+
+	recording = Recording.load(path)
+	print("{} recorded trains, {} to {}".format(len(recording.trains), recording.start(),
+												  recording.end()))
+	print("{:<18} {:>9} {:>9} {:>7} {:>9} {:>9} {:>8} {:>7}".format(
+		"policy", "train req", "term req", "trains", "mean err", "p95 err", "missing", "secs"))
+	for name in args.policies:
+		started = time.time()
+		requests, files = replay(recording, POLICIES[name])
+		errors, missing = timestamp_errors(path, files)
+		mean = sum(errors) / len(errors) if errors else 0
+		print("{:<18} {:>9} {:>9} {:>7} {:>9.1f} {:>9.1f} {:>8} {:>7.1f}".format(
+			name, requests[ts.TRAIN], requests[ts.TERMINAL], len(files), mean,
+			percentile(errors, 0.95), missing, time.time() - started))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,225 @@
+"""Local stand-in for the S3 bucket the scraper uploads train files to.
+
+Serves the files under a local directory as the objects of one bucket,
+keyed by their path relative to the directory (so a FileBackend root or a
+copy of scraped_data/ can be served as it is). Only what transit_parser
+needs is implemented: listing a prefix (ListObjects v1 and v2, paged),
+GET and HEAD of an object, with byte Range requests and If-Match. Objects
+carry an md5 ETag like single-part uploads do. Latency and error rate can
+be configured, and every request is counted.
+
+Point boto3 at it with:
+	boto3.resource('s3', endpoint_url='http://127.0.0.1:8009',
+				   aws_access_key_id='mock', aws_secret_access_key='mock',
+				   region_name='us-east-1')
+
+Run standalone with:
+	python s3_mock_server.py scraped_data/ --port 8009 --latency 0.02
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+BUCKET = "njtransit"
+range_re = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class MockObject:
+	"""A file served as an object."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		with open(filename, 'rb') as infile:
+			body = infile.read()
+		self.size = len(body)
+		self.etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+		self.modified = os.path.getmtime(filename)
+
+	def read(self, start=0, end=None):
+		with open(self.filename, 'rb') as infile:
+			infile.seek(start)
+			return infile.read((end if end is not None else self.size) - start)
+
+
+class MockS3:
+	"""The files under root as the objects of bucket.
+
+	Keyword arguments:
+	latency -- mean response delay in seconds (uniform +/- 50%)
+	error_rate -- fraction of requests answered with a 500
+	page_size -- keys per listing page, S3 returns at most 1000
+	"""
+
+	def __init__(self, root, bucket=BUCKET, latency=0.02, error_rate=0.0,
+				 page_size=1000, seed=0):
+		self.root = root
+		self.bucket = bucket
+		self.latency = latency
+		self.error_rate = error_rate
+		self.page_size = page_size
+		self.random = random.Random(seed)
+		self.counts = {}
+		self.bytes_sent = 0
+		self.lock = threading.Lock()
+		self.objects = {}
+		for directory, _, filenames in os.walk(root):
+			for filename in filenames:
+				path = os.path.join(directory, filename)
+				key = os.path.relpath(path, root).replace(os.sep, "/")
+				self.objects[key] = MockObject(path)
+		self.keys = sorted(self.objects)
+
+	def count(self, kind):
+		with self.lock:
+			self.counts[kind] = self.counts.get(kind, 0) + 1
+
+	def list_objects(self, query):
+		"""ListBucketResult XML for a listing request."""
+		prefix = query.get("prefix", [""])[0]
+		v2 = query.get("list-type", [""])[0] == "2"
+		if v2:
+			after = query.get("continuation-token", query.get("start-after", [""]))[0]
+		else:
+			after = query.get("marker", [""])[0]
+		max_keys = min(int(query.get("max-keys", [self.page_size])[0]), self.page_size)
+
+		keys = [k for k in self.keys if k.startswith(prefix) and k > after]
+		page, truncated = keys[:max_keys], len(keys) > max_keys
+		contents = []
+		for key in page:
+			obj = self.objects[key]
+			contents.append(
+				"<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>{}</ETag>"
+				"<Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>".format(
+					escape(key), datetime.utcfromtimestamp(obj.modified).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+					escape(obj.etag), obj.size))
+		if v2:
+			extra = "<KeyCount>{}</KeyCount>".format(len(page))
+			if truncated:
+				extra += "<NextContinuationToken>{}</NextContinuationToken>".format(escape(page[-1]))
+		else:
+			extra = "<Marker>{}</Marker>".format(escape(after))
+			if truncated:
+				extra += "<NextMarker>{}</NextMarker>".format(escape(page[-1]))
+		return ('<?xml version="1.0" encoding="UTF-8"?>'
+				'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+				'<Name>{}</Name><Prefix>{}</Prefix>{}<MaxKeys>{}</MaxKeys>'
+				'<IsTruncated>{}</IsTruncated>{}</ListBucketResult>'.format(
+					escape(self.bucket), escape(prefix), extra, max_keys,
+					"true" if truncated else "false", "".join(contents))).encode('utf-8')
+
+	def respond(self, method, path, query, headers):
+		"""Return (status, headers, body) for a request, after the simulated latency."""
+		if self.latency:
+			time.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+		parts = unquote(path).lstrip("/").split("/", 1)
+		if parts[0] != self.bucket:
+			return 404, {}, b"<Error><Code>NoSuchBucket</Code></Error>"
+		if len(parts) == 1 or not parts[1]:
+			self.count("list")
+			if self.random.random() < self.error_rate:
+				return 500, {}, b"<Error><Code>InternalError</Code></Error>"
+			return 200, {'Content-Type': 'application/xml'}, self.list_objects(query)
+
+		self.count(method.lower())
+		if self.random.random() < self.error_rate:
+			return 500, {}, b"<Error><Code>InternalError</Code></Error>"
+		obj = self.objects.get(parts[1])
+		if obj is None:
+			return 404, {}, b"<Error><Code>NoSuchKey</Code></Error>"
+		if headers.get('If-Match', obj.etag) != obj.etag:
+			return 412, {}, b"<Error><Code>PreconditionFailed</Code></Error>"
+		response = {'ETag': obj.etag, 'Accept-Ranges': 'bytes',
+					'Last-Modified': formatdate(obj.modified, usegmt=True),
+					'Content-Type': 'application/octet-stream'}
+		status, start, end = 200, 0, obj.size
+		match = range_re.match(headers.get('Range', ""))
+		if match is not None:
+			first, last = match.groups()
+			if first:
+				start = int(first)
+				end = min(int(last) + 1, obj.size) if last else obj.size
+			elif last:
+				start = max(obj.size - int(last), 0)
+			if start >= obj.size:
+				return 416, {'Content-Range': 'bytes */{}'.format(obj.size)}, b""
+			status = 206
+			self.count("range")
+			response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, obj.size)
+		body = obj.read(start, end) if method == "GET" else b""
+		with self.lock:
+			self.bytes_sent = self.bytes_sent + len(body)
+		response['Content-Length'] = str(end - start)
+		return status, response, body
+
+
+def serve(s3, port=0, host='127.0.0.1'):
+	"""Serve s3 from a daemon thread; returns the server (see server_port)."""
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+		# headers and body are written separately, don't wait for an ACK
+		disable_nagle_algorithm = True
+
+		def handle_request(self, method):
+			parts = urlsplit(self.path)
+			status, headers, body = s3.respond(method, parts.path, parse_qs(parts.query),
+											   self.headers)
+			self.send_response(status)
+			for name, value in headers.items():
+				self.send_header(name, value)
+			if 'Content-Length' not in headers:
+				self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			if method == "GET":
+				self.wfile.write(body)
+
+		def do_GET(self):
+			self.handle_request("GET")
+
+		def do_HEAD(self):
+			self.handle_request("HEAD")
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer((host, port), Handler)
+	server.daemon_threads = True
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('root', help='directory whose files are served as objects')
+	parser.add_argument('--port', type=int, default=8009)
+	parser.add_argument('--bucket', default=BUCKET)
+	parser.add_argument('--latency', type=float, default=0.02)
+	parser.add_argument('--error-rate', type=float, default=0.0)
+	args = parser.parse_args()
+
+	s3 = MockS3(args.root, bucket=args.bucket, latency=args.latency, error_rate=args.error_rate)
+	server = serve(s3, args.port)
+	print("serving {} objects of bucket {} on http://127.0.0.1:{}/".format(
+		len(s3.keys), s3.bucket, server.server_port))
+	try:
+		while True:
+			time.sleep(60)
+			print(s3.counts)
+	except KeyboardInterrupt:
+		server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,188 @@
+"""SQLite coordination between sharded scraper processes.
+
+Every worker process registers a shard name and heartbeats into a shared
+SQLite database. Terminals and new trains are assigned to the live shards
+by rendezvous hashing, so each train is scraped by exactly one process:
+
+- a worker that sees a train on a terminal board it scrapes either keeps
+  the sighting (it owns the train) or queues it in the sightings table for
+  the owning shard
+- the owner claims the train in the trains table before creating it; the
+  first claim wins, which deduplicates trains across shards for the day
+- when a shard stops heartbeating, its unfinished trains are adopted by
+  the shards they now hash to (data the dead shard had not uploaded stays
+  in its own checkpoint)
+
+Claimed trains keep their owner while it is alive, so a shard joining does
+not move trains that are already being scraped.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+SCHEMA = [
+	"""CREATE TABLE IF NOT EXISTS workers (
+		shard TEXT PRIMARY KEY,
+		heartbeat REAL NOT NULL)""",
+	"""CREATE TABLE IF NOT EXISTS trains (
+		day TEXT NOT NULL,
+		train_id TEXT NOT NULL,
+		owner TEXT NOT NULL,
+		line TEXT,
+		dep TEXT,
+		completed INTEGER NOT NULL DEFAULT 0,
+		PRIMARY KEY (day, train_id))""",
+	"""CREATE TABLE IF NOT EXISTS sightings (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		owner TEXT NOT NULL,
+		train_id TEXT NOT NULL,
+		line TEXT,
+		dep TEXT)""",
+	"CREATE INDEX IF NOT EXISTS sightings_owner ON sightings (owner)",
+]
+
+
+def rendezvous_owner(key, shards):
+	"""The shard with the highest hash of (shard, key); stable across processes."""
+	best, best_score = None, None
+	for shard in shards:
+		score = hashlib.md5("{}:{}".format(shard, key).encode('utf-8')).digest()
+		if best_score is None or score > best_score:
+			best, best_score = shard, score
+	return best
+
+
+class ShardCoordinator:
+	"""One shard's connection to the coordination database at path.
+
+	Keyword arguments:
+	heartbeat_timeout -- seconds without a heartbeat before a shard is dead
+	heartbeat_interval -- longest a worker should go between heartbeats
+	"""
+
+	def __init__(self, path, shard, heartbeat_timeout=30, heartbeat_interval=10):
+		self.path = path
+		self.shard = shard
+		self.heartbeat_timeout = heartbeat_timeout
+		self.heartbeat_interval = heartbeat_interval
+		self.live = [shard]
+
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		# autocommit, transactions are opened explicitly
+		self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		for statement in SCHEMA:
+			self.db.execute(statement)
+
+	def join(self):
+		"""Register, then wait a heartbeat interval so that shards started
+		together see each other before claiming any trains."""
+		self.heartbeat()
+		time.sleep(self.heartbeat_interval)
+		self.heartbeat()
+
+	def heartbeat(self):
+		"""Record that this shard is alive and refresh the live shards."""
+		now = time.time()
+		self.db.execute("INSERT OR REPLACE INTO workers (shard, heartbeat) VALUES (?, ?)",
+						(self.shard, now))
+		rows = self.db.execute("SELECT shard FROM workers WHERE heartbeat >= ?",
+							   (now - self.heartbeat_timeout,))
+		self.live = sorted(set([row[0] for row in rows] + [self.shard]))
+
+	def leave(self):
+		self.db.execute("DELETE FROM workers WHERE shard = ?", (self.shard,))
+		self.db.close()
+
+	def alive(self, shard):
+		"""Check the database rather than the live list cached at the last heartbeat."""
+		row = self.db.execute("SELECT heartbeat FROM workers WHERE shard = ?", (shard,)).fetchone()
+		return row is not None and row[0] >= time.time() - self.heartbeat_timeout
+
+	def owner_of(self, key):
+		return rendezvous_owner(key, self.live)
+
+	def owns(self, key):
+		return self.owner_of(key) == self.shard
+
+	def route(self, day, sightings):
+		"""Queue sightings of other shards' trains for them; return this shard's."""
+		local, remote = [], []
+		for sighting in sightings:
+			row = self.db.execute("SELECT owner, completed FROM trains WHERE day = ? AND train_id = ?",
+								  (day, sighting['train_id'])).fetchone()
+			if row is not None and row[0] in self.live:
+				owner = row[0]
+			else:
+				owner = self.owner_of(sighting['train_id'])
+			if owner == self.shard:
+				local.append(sighting)
+			else:
+				remote.append((owner, sighting['train_id'], sighting['line'], sighting['dep']))
+		if remote:
+			self.db.executemany("INSERT INTO sightings (owner, train_id, line, dep) VALUES (?, ?, ?, ?)",
+								remote)
+		return local
+
+	def receive(self):
+		"""Sightings other shards routed to this one since the last call."""
+		self.db.execute("BEGIN IMMEDIATE")
+		try:
+			rows = self.db.execute("SELECT id, train_id, line, dep FROM sightings WHERE owner = ?",
+								   (self.shard,)).fetchall()
+			if rows:
+				self.db.execute("DELETE FROM sightings WHERE owner = ? AND id <= ?",
+								(self.shard, rows[-1][0]))
+			self.db.execute("COMMIT")
+		except Exception:
+			self.db.execute("ROLLBACK")
+			raise
+		return [{'train_id': train_id, 'line': line, 'dep': dep}
+				for _, train_id, line, dep in rows]
+
+	def orphans(self, day):
+		"""Unfinished trains of dead shards that now hash to this shard."""
+		rows = self.db.execute("SELECT train_id, line, dep, owner FROM trains "
+							   "WHERE day = ? AND completed = 0", (day,)).fetchall()
+		return [{'train_id': train_id, 'line': line, 'dep': dep}
+				for train_id, line, dep, owner in rows
+				if owner not in self.live and self.owns(train_id)]
+
+	def claim(self, day, train):
+		"""Take ownership of a sighted train; False if another shard has it."""
+		self.db.execute("BEGIN IMMEDIATE")
+		try:
+			row = self.db.execute("SELECT owner, completed FROM trains WHERE day = ? AND train_id = ?",
+								  (day, train['train_id'])).fetchone()
+			if row is None:
+				self.db.execute("INSERT INTO trains (day, train_id, owner, line, dep) "
+								"VALUES (?, ?, ?, ?, ?)",
+								(day, train['train_id'], self.shard, train['line'], train['dep']))
+				claimed = True
+			elif row[0] == self.shard:
+				claimed = not row[1]
+			elif not row[1] and not self.alive(row[0]):
+				self.db.execute("UPDATE trains SET owner = ? WHERE day = ? AND train_id = ?",
+								(self.shard, day, train['train_id']))
+				claimed = True
+			else:
+				claimed = False
+			self.db.execute("COMMIT")
+		except Exception:
+			self.db.execute("ROLLBACK")
+			raise
+		return claimed
+
+	def complete(self, train_id):
+		self.db.execute("UPDATE trains SET completed = 1 "
+						"WHERE train_id = ? AND owner = ? AND completed = 0",
+						(train_id, self.shard))
+
+	def prune(self, day):
+		"""Forget trains from before day and sightings queued for dead shards."""
+		self.db.execute("DELETE FROM trains WHERE day < ?", (day,))
+		self.db.execute("DELETE FROM sightings WHERE owner NOT IN ({})".format(
+			",".join("?" * len(self.live))), self.live)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules read rail_data/ relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+import transit_scraper as ts
+
+START = datetime(2018, 4, 10, 8, 0)
+
+
+class OneTerminalScraper(ts.TerminalScraper):
+	"""Requests only the New York Penn board, like a shard owning one terminal."""
+
+	def polls(self, abbrev):
+		return abbrev == "NY"
+
+	def get_departures(self, abbrev):
+		return []
+
+
+def test_budget_is_charged_only_for_requested_boards(monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	budget = ts.TokenBucket(1, burst=100)
+	scraper = OneTerminalScraper(max_workers=1, budget=budget)
+	# every terminal is due at the first step
+	scraper.step()
+	assert budget.tokens == 99
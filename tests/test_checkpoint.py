@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+import transit_scraper as ts
+from checkpoint import Checkpoint
+
+START = datetime(2018, 4, 10, 8, 0)
+
+
+def page(first, second):
+	return [u"Newark Penn Station\xa0\xa0" + first, u"Secaucus Upper Lvl\xa0\xa0" + second]
+
+
+def checkpointed_scraper(path, monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path))
+	train = ts.Train("3837", "Northeast Corrdr", "8:05")
+	train.data = [[START, page("at 8:05", "at 8:15")],
+				  [START + timedelta(minutes=6), page("DEPARTED", "at 8:15")]]
+	train.page = train.data[-1][1]
+	train.scrape_count = 2
+	scraper.current_trains[train.id] = train
+	scraper.checkpoint.save(scraper)
+	scraper.checkpoint.log.close()
+	return train
+
+
+def test_restore_parses_scrape_times(tmp_path, monkeypatch):
+	path = str(tmp_path / "checkpoint.log")
+	original = checkpointed_scraper(path, monkeypatch)
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path))
+	train = scraper.current_trains[original.id]
+	assert [entry[0] for entry in train.data] == [entry[0] for entry in original.data]
+	assert train.page == original.page
+
+
+def test_restored_train_can_be_scored_and_rationed(tmp_path, monkeypatch):
+	path = str(tmp_path / "checkpoint.log")
+	original = checkpointed_scraper(path, monkeypatch)
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START + timedelta(minutes=20)))
+	now = ts.clock.now()
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path),
+								 budget=ts.TokenBucket(1, burst=1), priority=ts.TrainPriority())
+	train = scraper.current_trains[original.id]
+	# 8:15 at Secaucus has passed, last scrape 8:06
+	assert ts.TrainPriority().score(train, now) >= 5 * 60
+	second = ts.Train("3839", "Northeast Corrdr", "8:35")
+	scraper.current_trains[second.id] = second
+	# one request left: the train whose next departure has passed goes first
+	assert scraper.ration([second.id, original.id], now) == [original.id]
+
+
+class HeldUploader:
+	"""Takes uploads and never sends them, as if the process died first."""
+
+	def __init__(self):
+		self.submitted = {}
+		self.on_upload = None
+		self.on_spool = None
+		self.uploaded = 0
+		self.failed = 0
+
+	def depth(self):
+		return len(self.submitted)
+
+	def submit(self, key, body):
+		self.submitted[key] = body
+
+
+def test_completed_train_is_uploaded_again_until_upload_is_logged(tmp_path, monkeypatch):
+	path = str(tmp_path / "checkpoint.log")
+	original = checkpointed_scraper(path, monkeypatch)
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path), uploader=HeldUploader())
+	scraper.complete_train(original.id)
+	scraper.checkpoint.save(scraper)
+	# compacting must not drop the data of a train still in the upload queue
+	scraper.checkpoint.compact(scraper)
+	scraper.checkpoint.log.close()
+
+	uploader = HeldUploader()
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path), uploader=uploader)
+	assert original.id not in scraper.current_trains
+	assert list(uploader.submitted) == [original.s3_key()]
+	assert uploader.submitted[original.s3_key()] == original.to_json()
+
+	scraper.mark_uploaded(original.s3_key())
+	scraper.checkpoint.save(scraper)
+	scraper.checkpoint.log.close()
+	uploader = HeldUploader()
+	scraper = ts.TerminalScraper(max_workers=1, checkpoint=Checkpoint(path), uploader=uploader)
+	assert uploader.submitted == {}
+	assert scraper.completed_trains[original.id].uploaded
@@ -0,0 +1,30 @@
+import threading
+import time
+
+import transit_parser as tp
+
+
+def test_prefetch_bounds_unparsed_days(monkeypatch):
+	lock = threading.Lock()
+	started = []
+	most_unparsed = [0]
+	parsed = []
+
+	def download_train_files(date_string, path, prefix=''):
+		with lock:
+			started.append(date_string)
+			most_unparsed[0] = max(most_unparsed[0], len(started) - len(parsed))
+		time.sleep(0.01)
+
+	monkeypatch.setattr(tp, "download_train_files", download_train_files)
+	days = ["2018_04_{:02d}".format(day) for day in range(1, 9)]
+	for prefetch in [1, 2]:
+		del started[:], parsed[:]
+		most_unparsed[0] = 0
+		for date_string, seconds in tp.download_days_in_background(days, "", "", prefetch):
+			# parsing is slower than downloading, the downloader waits on it
+			time.sleep(0.05)
+			with lock:
+				parsed.append(date_string)
+		assert parsed == days
+		assert most_unparsed[0] == prefetch + 1
@@ -0,0 +1,47 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import transit_scraper as ts
+from dv_client import DVClient
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		time.sleep(0.05)
+		self.send_response(200)
+		self.send_header('Content-Length', '2')
+		self.end_headers()
+		self.wfile.write(b"ok")
+
+	def log_message(self, *args):
+		pass
+
+
+def test_pool_holds_a_connection_per_worker(caplog):
+	server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = "http://127.0.0.1:{}/".format(server.server_port)
+
+	client = DVClient(pool_size=16)
+	client.ensure_pool_size(32)
+	client.ensure_pool_size(8)
+	assert client.pool_size == 32
+	with caplog.at_level(logging.WARNING, logger="urllib3"):
+		with ThreadPoolExecutor(max_workers=32) as pool:
+			for _ in range(3):
+				list(pool.map(lambda _: client.get(url).status_code, range(32)))
+	server.shutdown()
+	# a pool smaller than the workers discards connections ("pool is full")
+	assert not [r for r in caplog.records if "pool is full" in r.getMessage()]
+	assert client.stats()["connections"] <= 32
+
+
+def test_scraper_sizes_shared_client_pool():
+	ts.TerminalScraper(max_workers=40)
+	assert ts.DV.pool_size >= 40
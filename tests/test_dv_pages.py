@@ -0,0 +1,80 @@
+import os
+import random
+
+import pytest
+
+import dv_pages
+
+bs4 = pytest.importorskip("bs4")
+pytest.importorskip("lxml")
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+PAGES = sorted(name for name in os.listdir(FIXTURES) if name.endswith(".html"))
+# pages whose expected output differs from BeautifulSoup on purpose
+DIVERGENT = ["train_stops_script.html"]
+
+
+def read(name):
+	with open(os.path.join(FIXTURES, name), encoding="utf-8", newline="") as infile:
+		return infile.read()
+
+
+def soup_train_stops(html):
+	table = bs4.BeautifulSoup(html, "lxml").find("table")
+	if table is None:
+		return []
+	return [td.text for td in table.find_all("td")]
+
+
+def soup_departure_rows(html):
+	soup = bs4.BeautifulSoup(html, "lxml")
+	return [[td.text for td in table.find_all("td")] for table in soup.find_all("table")
+			if table.parent.name == "td"]
+
+
+@pytest.mark.parametrize("name", [name for name in PAGES if name not in DIVERGENT])
+def test_fixtures_match_beautifulsoup(name):
+	html = read(name)
+	assert dv_pages.train_stops(html) == soup_train_stops(html)
+	assert dv_pages.departure_rows(html) == soup_departure_rows(html)
+
+
+def test_script_text_is_kept_in_cells():
+	# newer BeautifulSoup releases leave <script> and <style> strings out of
+	# Tag.text, 4.4.1 (which the scraper used) kept them like the extractor
+	# does; DepartureVision cells hold no scripts
+	html = read("train_stops_script.html")
+	assert dv_pages.train_stops(html) == [
+		u'Newark Penn Station\xa0\xa0at 8:27var t = "<td>x</td>";',
+		u'td { color: red }Secaucus Upper Lvl\xa0\xa0at 8:35']
+	assert soup_train_stops(html) == [u"Newark Penn Station\xa0\xa0at 8:27",
+									  u"Secaucus Upper Lvl\xa0\xa0at 8:35"]
+
+
+def random_page(rng):
+	"""A departures page with random whitespace, entities, inline tags and
+	cells and rows left unclosed."""
+	def text():
+		words = [rng.choice(["Newark", "Penn", "at", "8:05", "DEPARTED", "&amp;", "&nbsp;",
+							 "&#160;", "<b>Sec</b>", "<span>3</span>", "<br>", " ", "\r\n", "\t"])
+				 for _ in range(rng.randint(0, 5))]
+		return "".join(words)
+
+	def close(tag):
+		return "</{}>".format(tag) if rng.random() < 0.7 else ""
+
+	rows = []
+	for _ in range(rng.randint(0, 6)):
+		cells = "".join("<td>{}{}".format(text(), close("td")) for _ in range(rng.randint(1, 6)))
+		if rng.random() < 0.5:
+			cells = "<td><table><tr>{}</tr></table></td>".format(cells)
+		rows.append("<tr>{}{}{}".format(cells, close("tr"), rng.choice(["", "\n", "\r\n"])))
+	return "<html><body>{}<table>{}</table></body></html>".format(text(), "".join(rows))
+
+
+def test_random_pages_match_beautifulsoup():
+	rng = random.Random(0)
+	for _ in range(300):
+		html = random_page(rng)
+		assert dv_pages.train_stops(html) == soup_train_stops(html), html
+		assert dv_pages.departure_rows(html) == soup_departure_rows(html), html
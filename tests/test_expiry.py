@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import transit_scraper as ts
+
+START = datetime(2018, 4, 10, 8, 0)
+
+
+class PagedTrain(ts.Train):
+	"""Answers each request with the page pages(now) returns."""
+	__slots__ = ()
+	pages = None
+
+	def request(self, timeout=3, retry=False):
+		return self.pages(ts.clock.now())
+
+
+def run(train, until, step=60):
+	"""Scrape train every step seconds until it completes or until;
+	returns the time it stopped."""
+	while ts.clock.now() < until and not train.completed:
+		train.scrape()
+		ts.clock.sleep(step)
+	return ts.clock.now()
+
+
+def test_unscheduled_train_waiting_to_depart_is_not_idle(monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	waiting = [u"New York Penn Station\xa0\xa0at 8:30", u"Newark Penn Station\xa0\xa0at 8:45"]
+	monkeypatch.setattr(PagedTrain, "pages", lambda self, now: waiting)
+	train = PagedTrain("A171", "Amtrak", "8:30")
+	assert not train.scheduled
+	stopped = run(train, START + timedelta(hours=2))
+	# only scrapes after the listed 8:30 departure count as idle
+	assert train.expired == "idle"
+	assert stopped >= START + timedelta(minutes=30 + ts.Train.expiry.max_idle)
+
+
+def test_late_train_with_changing_page_is_not_retired(monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	train = PagedTrain("3837", "Northeast Corrdr", "8:05")
+	end = ts.Train.expiry.scheduled_end(train)
+	assert end is not None
+	# a page that changes every scrape, as a train still running does
+	monkeypatch.setattr(PagedTrain, "pages", lambda self, now: [
+		u"Newark Penn Station\xa0\xa0at {}:{:02d}".format(now.hour % 12 or 12, now.minute)])
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(end + timedelta(minutes=50)))
+	run(train, end + timedelta(hours=2))
+	assert not train.completed
@@ -0,0 +1,21 @@
+from datetime import datetime, timedelta
+
+import transit_scraper as ts
+
+DAY = datetime(2018, 4, 10)
+
+
+def test_every_departure_is_on_a_polled_board():
+	polling = ts.TerminalPolling(ts.TERMINALS)
+	polling.refresh(DAY)
+	assert polling.departures
+	for name, departures in polling.departures.items():
+		seen = set()
+		now = DAY
+		while now < DAY + timedelta(days=1):
+			seconds = (now - DAY).seconds
+			board = [d for d in departures if d >= seconds][:polling.board_size]
+			seen.update(board)
+			now = now + timedelta(seconds=polling.interval(name, now))
+		missed = [d for d in departures if d >= 0 and d < 86400 and d not in seen]
+		assert missed == [], name
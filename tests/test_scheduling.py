@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+import transit_scraper as ts
+
+START = datetime(2018, 4, 10, 8, 0)
+
+
+def test_sighting_keeps_retry_delay(monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	scraper = ts.TerminalScraper(max_workers=1)
+	sighting = {'train_id': '3837', 'line': 'Northeast Corrdr', 'dep': '8:05'}
+	scraper.create_new_trains([sighting])
+	train = scraper.current_trains['3837']
+	# the fetch failed: t_scrape is unchanged and the train is retried shortly
+	retry = START + timedelta(seconds=scraper.retry_delay)
+	scraper.schedule(ts.TRAIN, '3837', retry)
+	assert train.t_scrape != retry
+
+	scraper.find_new_trains([sighting])
+	scraper.create_new_trains([sighting])
+	assert scraper.queued[(ts.TRAIN, '3837')] == retry
+
+
+def test_earlier_dep_moves_first_scrape(monkeypatch):
+	monkeypatch.setattr(ts, "clock", ts.SimulatedClock(START))
+	scraper = ts.TerminalScraper(max_workers=1)
+	# not in the schedule, first scraped ahead of its listed departure
+	scraper.create_new_trains([{'train_id': 'A171', 'line': 'AMTRAK', 'dep': '10:05'}])
+	train = scraper.current_trains['A171']
+	assert not train.scheduled
+	scraper.find_new_trains([{'train_id': 'A171', 'line': 'AMTRAK', 'dep': '9:05'}])
+	assert train.dep == '9:05'
+	assert scraper.queued[(ts.TRAIN, 'A171')] == train.t_scrape
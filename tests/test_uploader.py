@@ -0,0 +1,27 @@
+import os
+
+from uploader import TrainUploader, TMP_SUFFIX
+
+
+class FailingBackend:
+	def put(self, key, body, compressed=False):
+		raise IOError("unreachable")
+
+
+def test_spool_is_written_whole_and_partial_files_are_not_resent(tmp_path):
+	spool_dir = str(tmp_path / "spool") + "/"
+	uploader = TrainUploader(FailingBackend(), workers=0, spool_dir=spool_dir,
+							 spool_interval=3600)
+	key = "aws/2018_04_10/2018_04_10_3837"
+	uploader.spool(key, b"{}")
+	# a crash while spooling another train leaves its temporary file
+	partial = uploader.spool_path("aws/2018_04_10/2018_04_10_3839") + TMP_SUFFIX
+	with open(partial, 'wb') as outfile:
+		outfile.write(b"{")
+
+	assert uploader.spooled_keys() == [key]
+	with open(uploader.spool_path(key), 'rb') as infile:
+		assert infile.read() == b"{}"
+	assert sorted(os.listdir(os.path.dirname(uploader.spool_path(key)))) == \
+		["2018_04_10_3837", "2018_04_10_3839" + TMP_SUFFIX]
+	uploader.close(timeout=1)
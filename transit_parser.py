@@ -1,34 +1,61 @@
 import json
+import gzip
+import hashlib
+import pickle
+import numpy as np
 import pandas as pd
 import re
 from datetime import datetime, timedelta
 import boto3
+from botocore.config import Config
 import os
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import isfile, join
 from pathlib import Path
+from rail_data.schedule import get_schedule
+import dv_pages
+
+# created on first use, building the resource is slow
+s3 = None
+# connections kept open to S3, at least download_train_files' workers
+S3_CONNECTIONS = 50
+
+
+def get_s3():
+	global s3
+	if s3 is None:
+		s3 = boto3.resource('s3', config=Config(max_pool_connections=S3_CONNECTIONS))
+	return s3
 
-s3 = boto3.resource('s3')
 
 TIME_LEN = len("YYYY-MM-DD HH:MM:SS")
 DAY_LEN = len("YYYY-MM-DD ")
 RAIL_DATA = "./rail_data/"
 ALL_STATIONS = json.load(open(RAIL_DATA + 'rail_stations'))
 BUCKET = "njtransit"
-
-TRIPS = pd.read_csv(RAIL_DATA + 'trips.txt')
-STOP_TIMES = pd.read_csv(RAIL_DATA + 'stop_times.txt')
-TRIP_STOPS = STOP_TIMES.merge(TRIPS, on=['trip_id'])
-TRIP_STOPS.rename(columns={'arrival_time': 'expected'}, inplace=True)
+# bump whenever a change to the parser changes its output, so that
+# incremental parses (see ParseCache) re-parse every file
+PARSER_VERSION = 2
 
 class TrainParser:
-	time_re = re.compile(".*?(\d+):(\d+).*")
+	time_re = re.compile(r".*?(\d+):(\d+).*")
 	departed_statuses = ["Departed", "DEPARTED", "departed"]
 	cancelled_statuses = ["Cancelled", "CANCELLED", "cancelled"]
 	minimum_number_statuses = 3
 
-	def __init__(self, filename):
+	def __init__(self, filename, data=None):
+		"""Parse the train file at filename, or an already loaded data dict
+		(filename is then only used as a label)."""
 		self.filename = filename
-		self.data = self.read_file(self.filename)
+		if data is None:
+			data = self.read_file(self.filename)
+		else:
+			data = self.decode(data)
+		self.data = data
 		self.train = self.data['id']
 		self.line = self.data['line']
 		self.type = self.data['type']
@@ -47,11 +74,22 @@ class TrainParser:
 		self.num_lines_in_page = -1
 
 	def read_file(self, filename):
+		raw = open(filename, 'rb').read()
+		if raw[:2] == b'\x1f\x8b':
+			# uploaded gzip-compressed by the scraper's TrainUploader
+			raw = gzip.decompress(raw)
+		contents = raw.decode('utf-8')
 		try:
-			return json.load(open(filename))
+			data = json.loads(contents)
 		except ValueError:
-			contents = open(filename).read().split('}{')
-			return json.loads(contents[0] + '}')
+			contents = contents.split('}{')
+			data = json.loads(contents[0] + '}')
+		return self.decode(data)
+
+	def decode(self, data):
+		if data.get('encoding') == 'delta':
+			data['data'] = dv_pages.decode_pages(data['data'])
+		return data
 
 	def check_page_valid(self, page):
 		# len 3 --> two stops + empty string
@@ -67,8 +105,7 @@ class TrainParser:
 		return True
 
 	def check_file_empty(self):
-		first_status_page = self.data['data'][0][1]
-		if not self.check_page_valid(first_status_page):
+		if not self.data['data'] or not self.check_page_valid(self.data['data'][0][1]):
 			self.corrupted = True
 			self.corrupted_reason = "empty file"
 			# print(self.filename, "corrupted empty")
@@ -337,29 +374,10 @@ class TrainParser:
 		rows = self.get_rows()
 		return self.get_df(rows)
 
-	def format_schedule_time(self, scheduled):
-		date, time = scheduled.split(" ")
-		hours, minutes, seconds = time.split(":")
-		hours, minutes, seconds = int(hours), int(minutes), int(seconds)
-		midnight = datetime.strptime(date, "%Y-%m-%d")
-		actual_time = midnight + timedelta(hours=hours, minutes=minutes)
-		return actual_time.strftime("%Y-%m-%d %H:%M:%S")
-	
 	def join_schedule(self, df):
 		if df is None:
 			return None
-		num_stops = len(df)
-		if self.scheduled:
-			stops = TRIP_STOPS[TRIP_STOPS['block_id'] == self.train].copy()
-			stops.drop_duplicates(subset='stop_id', inplace=True)
-			stops = stops[['expected', 'stop_sequence', 'stop_id']]
-			stops['expected'] = self.created_at[:DAY_LEN] + stops['expected']
-			stops['expected'] = stops['expected'].apply(lambda x: self.format_schedule_time(x))
-			return df.merge(stops, left_on='to_id', right_on='stop_id', how='left')
-		else:
-			df['expected'] = None
-			df['stop_sequence'] = None
-			return df
+		return join_schedule([df])
 
 	def check_df_valid(self, df):
 		if df is None:
@@ -371,6 +389,166 @@ class TrainParser:
 			# print("not valid len", self.filename)
 		return valid_len
  
+def join_schedule(train_dfs):
+	"""Concatenate the DataFrames of a day's trains and join each stop's
+	scheduled time and sequence ('expected', 'stop_sequence') in one merge.
+
+	The values and dtypes are those of joining each train on its own and
+	concatenating: a train that is not scheduled gets None, one without
+	a schedule for the day NaN, and stop_sequence stays integer for trains
+	whose every stop is scheduled, so the day's CSV is unchanged.
+	"""
+	df = pd.concat(train_dfs, ignore_index=True)
+	lengths = [len(train_df) for train_df in train_dfs]
+	part = np.repeat(np.arange(len(train_dfs)), lengths)
+	scheduled = df['scheduled'].isin([True]).values
+
+	# each (date, train) once; the first of a stop's scheduled times, as
+	# TrainParser kept with drop_duplicates
+	schedule = get_schedule(RAIL_DATA)
+	keys = df.loc[scheduled, ['date', 'train_id']].drop_duplicates()
+	dates, train_ids, stop_ids, sequences, minutes = [], [], [], [], []
+	no_schedule_keys = set()
+	for date, train_id in zip(keys['date'].tolist(), keys['train_id'].tolist()):
+		stops = schedule.get(datetime.strptime(date, "%Y-%m-%d"), train_id)
+		if not stops:
+			no_schedule_keys.add((date, train_id))
+		seen = set()
+		for arrival, stop_id, sequence in stops:
+			if stop_id in seen:
+				continue
+			seen.add(stop_id)
+			# GTFS hours run past 24 for trains after midnight; seconds are dropped
+			hours, mins = arrival.split(":")[:2]
+			dates.append(date)
+			train_ids.append(train_id)
+			stop_ids.append(stop_id)
+			sequences.append(sequence)
+			minutes.append(int(hours) * 60 + int(mins))
+	stops = pd.DataFrame({'date': dates, 'train_id': train_ids, 'stop_id': stop_ids,
+						  'stop_sequence': np.array(sequences, dtype='int64')})
+	expected = pd.to_datetime(pd.Series(dates, dtype=object), format="%Y-%m-%d") + \
+		pd.to_timedelta(np.array(minutes, dtype='int64'), unit='m')
+	stops['expected'] = expected.dt.strftime("%Y-%m-%d %H:%M:%S").values
+
+	joined = df.merge(stops, how='left', left_on=['date', 'train_id', 'to_id'],
+					  right_on=['date', 'train_id', 'stop_id'])
+	joined = joined.drop('stop_id', axis=1)
+
+	# per train: not scheduled, no schedule for the day, or how many stops matched
+	matched = joined['stop_sequence'].notnull().values
+	matched_per_part = np.bincount(part, weights=matched, minlength=len(lengths))
+	no_schedule = np.zeros(len(df), dtype=bool)
+	if no_schedule_keys:
+		no_schedule = np.array([(date, train_id) in no_schedule_keys for date, train_id in
+								zip(joined['date'].tolist(), joined['train_id'].tolist())]) & scheduled
+	unscheduled = ~scheduled
+	partial = ~(matched_per_part == np.array(lengths))[part]
+	if unscheduled.any() or no_schedule.any():
+		# trains without a schedule have object columns, which keep each
+		# train's own ints and floats when concatenated
+		sequence = joined['stop_sequence'].astype(object)
+		whole = ~partial & ~unscheduled & ~no_schedule
+		sequence[whole] = [int(x) for x in joined['stop_sequence'][whole]]
+		sequence[unscheduled] = None
+		joined['stop_sequence'] = sequence
+		expected = joined['expected'].astype(object)
+		expected[unscheduled] = None
+		joined['expected'] = expected
+	elif not partial.any():
+		joined['stop_sequence'] = joined['stop_sequence'].astype('int64')
+	return joined
+
+
+class InvalidTrain:
+	"""The parts of a TrainParser that failed to parse which log_invalid_trains
+	uses; sent back by worker processes instead of the whole parser."""
+
+	def __init__(self, filename, train, corrupted_reason):
+		self.filename = filename
+		self.train = train
+		self.corrupted_reason = corrupted_reason
+
+
+def parse_train_file(filename):
+	"""Parse one train file in a worker process.
+
+	Returns (DataFrame, None) or, if the train is invalid, (None, InvalidTrain).
+	"""
+	train_obj = TrainParser(filename)
+	train_df = DayParser.parse_train(train_obj)
+	if train_df is None:
+		return None, InvalidTrain(filename, train_obj.train, train_obj.corrupted_reason)
+	return train_df, None
+
+
+class ParseCache:
+	"""Parsed output of each train file in a day's directory, kept in
+	directory/.parsed/ so that incremental parses only re-parse new or
+	changed files.
+
+	manifest.json maps each filename to the md5 of the file and the
+	PARSER_VERSION that parsed it, plus the train id and reason if it was
+	invalid; valid trains' DataFrames are pickled next to it. The schedule
+	is joined after the day is assembled, so the cache does not depend on
+	the GTFS files.
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory + '.parsed/'
+		self.path = self.directory + 'manifest.json'
+		self.files = {}
+		if os.path.exists(self.path):
+			try:
+				with open(self.path) as infile:
+					self.files = json.load(infile)['files']
+			except (ValueError, KeyError):
+				# start over rather than fail on a bad manifest
+				self.files = {}
+
+	def pickle_path(self, filename):
+		return self.directory + filename + '.pickle'
+
+	def current(self, filename, md5):
+		entry = self.files.get(filename)
+		return entry is not None and entry['md5'] == md5 and entry['version'] == PARSER_VERSION
+
+	def store(self, filename, md5, train_df, invalid):
+		"""Record a file's parse, (DataFrame, None) or (None, InvalidTrain)."""
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		entry = {'md5': md5, 'version': PARSER_VERSION}
+		if train_df is not None:
+			tmp_path = self.pickle_path(filename) + '.tmp'
+			with open(tmp_path, 'wb') as outfile:
+				pickle.dump(train_df, outfile, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_path, self.pickle_path(filename))
+		else:
+			entry['invalid'] = [invalid.train, invalid.corrupted_reason]
+		self.files[filename] = entry
+
+	def load(self, filename, filepath):
+		"""(DataFrame, None) or (None, InvalidTrain) as stored for filename."""
+		entry = self.files[filename]
+		if 'invalid' in entry:
+			return None, InvalidTrain(filepath, *entry['invalid'])
+		with open(self.pickle_path(filename), 'rb') as infile:
+			return pickle.load(infile), None
+
+	def save(self, filenames):
+		"""Write the manifest, forgetting files that are not in filenames."""
+		for filename in set(self.files) - set(filenames):
+			entry = self.files.pop(filename)
+			if 'invalid' not in entry and os.path.exists(self.pickle_path(filename)):
+				os.remove(self.pickle_path(filename))
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as outfile:
+			json.dump({'files': self.files}, outfile, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+
 class DayParser:
 	"""Parses train files in a directory, which correspond to a day.
 
@@ -386,7 +564,7 @@ class DayParser:
 		self.path = path + day + '/'
 		self.day = day
 		self.csv_path = csv_path
-		self.files = [f for f in os.listdir(self.path) if not f.startswith(".")]
+		self.files = sorted(f for f in os.listdir(self.path) if not f.startswith("."))
 		self.all_trains_df = pd.DataFrame(columns=self.df_columns)
 		self.invalid_trains = []
 	
@@ -395,27 +573,38 @@ class DayParser:
 		# print(train_filename)
 		return TrainParser(train_filename)
 
-	def parse_train(self, train):
+	@classmethod
+	def parse_train(cls, train):
 		"""
 		Parse data in a train file to a DataFrame where each row represents a
 		pair of stops along journey. 
 		
 		Creates a TrainParser instance from a train file, parses file data to
-		DataFrame, joins schedule data to dataframe, and returns DataFrame.
+		DataFrame, and returns DataFrame. The schedule is joined for the whole
+		day (see join_schedule).
 		"""
 		if train.check_file_empty():
 			return None
 		train_df = train.parse_file_to_df()
-		performance = train.join_schedule(train_df)
-		if not train.check_df_valid(performance):
+		if not train.check_df_valid(train_df):
 			return None
 		else:
-			return performance[self.df_columns]
+			return train_df
 
-	def parse_all_trains(self):
+	def parse_all_trains(self, workers=None, incremental=False):
 		"""Parse all train files in directory to dataframe (self.all_trains_df).
 		If unable to parse train file, store train id (self.invalid_trains).
+
+		Keyword arguments:
+		workers -- parse files in a pool of this many processes; invalid
+				   trains are then stored as InvalidTrain records
+		incremental -- only parse files that are not in the day's ParseCache,
+					   then assemble the day from the cache
 		"""
+		if incremental:
+			return self.parse_all_trains_incremental(workers)
+		if workers is not None and workers > 1:
+			return self.parse_all_trains_parallel(workers)
 		all_trains = []
 		for train in self.files:
 			train_obj = self.get_train_obj(train)
@@ -424,9 +613,47 @@ class DayParser:
 				all_trains.append(train_df)
 			else:
 				self.invalid_trains.append(train_obj)
-		self.all_trains_df = pd.concat(all_trains, ignore_index=True)
+		self.all_trains_df = join_schedule(all_trains)[self.df_columns]
+		self.log_invalid_trains()
+
+	def parse_files(self, filenames, workers=None):
+		"""(DataFrame, None) or (None, InvalidTrain) for each file, in order."""
+		filepaths = [self.path + f for f in filenames]
+		if workers is None or workers <= 1 or len(filepaths) < 2:
+			return [parse_train_file(filepath) for filepath in filepaths]
+		chunksize = max(1, len(filepaths) // (workers * 4))
+		pool = multiprocessing.Pool(workers)
+		try:
+			# map returns results in file order, so the output matches parse_all_trains
+			return pool.map(parse_train_file, filepaths, chunksize)
+		finally:
+			pool.close()
+			pool.join()
+
+	def collect(self, results):
+		all_trains = []
+		for train_df, invalid in results:
+			if train_df is not None:
+				all_trains.append(train_df)
+			else:
+				self.invalid_trains.append(invalid)
+		self.all_trains_df = join_schedule(all_trains)[self.df_columns]
 		self.log_invalid_trains()
 
+	def parse_all_trains_parallel(self, workers):
+		self.collect(self.parse_files(self.files, workers))
+
+	def parse_all_trains_incremental(self, workers=None):
+		cache = ParseCache(self.path)
+		hashes = dict((f, file_md5(self.path + f)) for f in self.files)
+		stale = [f for f in self.files if not cache.current(f, hashes[f])]
+		for filename, result in zip(stale, self.parse_files(stale, workers)):
+			cache.store(filename, hashes[filename], *result)
+		cache.save(self.files)
+		print("parsed {} new or changed files for {}, {} from cache".format(
+			len(stale), self.day, len(self.files) - len(stale)))
+		self.collect(cache.load(f, self.path + f) for f in self.files)
+
 	def write_day_to_disk(self, print_results=True):
 		"""Write dataframe of vaid parsed trains to disk.
 
@@ -483,61 +710,243 @@ def create_directory(dir_name, path='./scraped_data/'):
 		os.makedirs(directory)
 	return directory
 
-def write_s3_obj_to_disk(s3_obj, directory):
-	"""Read s3_obj data, get filename, and write to path + filename.
+class DownloadManifest:
+	"""ETag and size of each train file downloaded into directory, kept in
+	directory/.manifest.json so that re-runs skip files already on disk."""
+
+	def __init__(self, directory):
+		self.path = directory + '.manifest.json'
+		self.directory = directory
+		self.lock = threading.Lock()
+		self.files = {}
+		if os.path.exists(self.path):
+			try:
+				with open(self.path) as infile:
+					self.files = json.load(infile)
+			except ValueError:
+				# written atomically, but start over rather than fail on a bad file
+				self.files = {}
+
+	def current(self, filename, etag, size):
+		"""True if filename was downloaded from this version of the object."""
+		entry = self.files.get(filename)
+		if entry is None or entry['etag'] != etag or entry['size'] != size:
+			return False
+		try:
+			return os.path.getsize(self.directory + filename) == size
+		except OSError:
+			return False
+
+	def record(self, filename, etag, size):
+		with self.lock:
+			self.files[filename] = {'etag': etag, 'size': size}
+
+	def save(self):
+		with self.lock:
+			data = json.dumps(self.files, sort_keys=True)
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as outfile:
+			outfile.write(data)
+		os.replace(tmp_path, self.path)
+
+
+def part_filename(directory, filename, etag):
+	"""Partial download of one version of a file; dot-prefixed so DayParser
+	ignores it."""
+	return '{}.{}.{}.part'.format(directory, filename, etag.strip('"'))
+
+def write_s3_obj_to_disk(key, etag, size, directory, chunk_size=64 * 1024):
+	"""Download object key to directory, resuming an interrupted download.
+
+	The object is streamed into a .part file named after its ETag; a part
+	left by an earlier attempt at the same ETag is continued with a Range
+	request. The file is renamed into place once complete.
 
 	Keyword arguments:
-	s3_obj -- object from s3 bucket
+	key -- S3 key of the object
+	etag, size -- of the object as listed
 	directory -- relative folder path to write file data
 	"""
-	filename = s3_obj.key.split("/")[-1]
-	data = s3_obj.get()['Body'].read()
-	outfile = open(directory + filename, 'wb')
-	outfile.write(data)
-	outfile.close()
-
-
-def download_train_files(date_string, path='./scraped_data/', prefix=''):
+	filename = key.split("/")[-1]
+	part = part_filename(directory, filename, etag)
+	offset = os.path.getsize(part) if os.path.exists(part) else 0
+	if offset > size:
+		os.remove(part)
+		offset = 0
+	if offset < size or size == 0:
+		request = {'Bucket': BUCKET, 'Key': key, 'IfMatch': etag}
+		if offset:
+			request['Range'] = 'bytes={}-'.format(offset)
+		body = get_s3().meta.client.get_object(**request)['Body']
+		with open(part, 'ab' if offset else 'wb') as outfile:
+			for chunk in iter(lambda: body.read(chunk_size), b''):
+				outfile.write(chunk)
+
+	written = os.path.getsize(part)
+	# single part uploads have the md5 as ETag
+	md5 = etag.strip('"')
+	if written != size or ('-' not in md5 and file_md5(part) != md5):
+		os.remove(part)
+		raise IOError("download of {} does not match its ETag and size".format(key))
+	os.replace(part, directory + filename)
+	return filename
+
+def file_md5(filename):
+	digest = hashlib.md5()
+	with open(filename, 'rb') as infile:
+		for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def download_train_files(date_string, path='./scraped_data/', prefix='', workers=16,
+						 save_every=100):
 	
 	"""Download files from bucket/prefix/date_string, write files to disk.
 
+	Files are fetched from a pool of threads. Files whose ETag and size
+	match the directory's DownloadManifest are skipped, and interrupted
+	downloads are resumed (see write_s3_obj_to_disk). Downloads that fail
+	are raised as one IOError after the rest have finished.
+
 	Keyword arguments:
 	date_string -- date prefix to group train files by day on S3 ('YYYY_MM_DD')
 	path -- relative folder path where scraped data is stored
 	prefix -- S3 prefix where train files are stored
+	workers -- concurrent downloads
+	save_every -- downloads between manifest saves, so an interrupted run
+				  keeps what it had fetched
+
+	Returns (files downloaded, files skipped).
 	"""
 	directory = create_directory(date_string, path)
-	bucket = s3.Bucket(BUCKET)
+	manifest = DownloadManifest(directory)
+	bucket = get_s3().Bucket(BUCKET)
+	pending, skipped = [], 0
 	for obj in bucket.objects.filter(Prefix=prefix+date_string+'/'):
-		write_s3_obj_to_disk(obj, directory)
-
-def parse_days(days, path='scraped_trains/'):
+		if manifest.current(obj.key.split("/")[-1], obj.e_tag, obj.size):
+			skipped = skipped + 1
+		else:
+			pending.append((obj.key, obj.e_tag, obj.size))
+	# parts of object versions that are no longer listed can't be resumed
+	parts = set(part_filename(directory, key.split("/")[-1], etag) for key, etag, _ in pending)
+	for filename in os.listdir(directory):
+		if filename.endswith('.part') and directory + filename not in parts:
+			os.remove(directory + filename)
+
+	failed = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = dict((executor.submit(write_s3_obj_to_disk, key, etag, size, directory),
+						(etag, size)) for key, etag, size in pending)
+		try:
+			for i, future in enumerate(as_completed(futures)):
+				try:
+					filename = future.result()
+				except Exception as e:
+					failed.append(e)
+					continue
+				manifest.record(filename, *futures[future])
+				if (i + 1) % save_every == 0:
+					manifest.save()
+		finally:
+			manifest.save()
+	if failed:
+		raise IOError("{} of {} downloads for {} failed, first: {}".format(
+			len(failed), len(pending), date_string, failed[0]))
+	return len(pending), skipped
+
+def parse_days(days, path='scraped_trains/', workers=None, incremental=False):
 	"""Parse all train files for one day into CSV for a day. Write CSV to disk.
 
 	Keyword arguments:
 	days -- list of date strings, e.g. ['2018-03-01', '2018-03-02', ...]
 	path -- relative folder path where scraped data is stored
+	workers -- number of parser processes (see DayParser.parse_all_trains)
+	incremental -- only parse files not already parsed (see ParseCache)
 	"""
 	for date_string in days:
 		d = DayParser(path, date_string)
-		d.parse_all_trains()
+		d.parse_all_trains(workers, incremental)
 		d.write_day_to_disk()
 		print("completed parsing {}".format(date_string))
 
-def download_and_parse_days(days, path='./scraped_data/', prefix=''):
+def download_and_parse_days(days, path='./scraped_data/', prefix='', workers=None,
+							prefetch=1, csv_path='./csv/', incremental=False):
 	"""Download and parse train files for days.
 
+	Days are downloaded by a background thread while earlier days are
+	parsed. Besides the day being parsed, at most prefetch days are being
+	downloaded or waiting for the parser, so at most prefetch + 1 days are
+	on disk unparsed.
+
 	Keyword arguments:
 	days -- list of date strings, e.g. ['2018-03-01', '2018-03-02', ...]
 	path -- relative folder path where scraped data is stored
 	prefix -- S3 prefix where train files are stored
+	workers -- number of parser processes (see DayParser.parse_all_trains)
+	prefetch -- days downloaded ahead of the parser; 0 downloads and parses
+				each day in turn
+	csv_path -- relative folder path where parsed CSVs are written
+	incremental -- only parse files not already parsed (see ParseCache)
 	"""
+	started = time.time()
+	if prefetch > 0:
+		downloaded = download_days_in_background(days, path, prefix, prefetch)
+	else:
+		downloaded = download_days(days, path, prefix)
+
+	for i, (date_string, download_secs) in enumerate(downloaded):
+		parse_started = time.time()
+		d = DayParser(path, date_string, csv_path)
+		d.parse_all_trains(workers, incremental)
+		d.write_day_to_disk()
+		print("completed {} ({}/{}): downloaded in {:.1f}s, parsed in {:.1f}s, "
+			  "{:.1f}s elapsed".format(date_string, i + 1, len(days), download_secs,
+									   time.time() - parse_started, time.time() - started))
 
+def download_days(days, path, prefix):
+	"""Download days in turn, yielding (date_string, download seconds)."""
 	for date_string in days:
+		download_started = time.time()
 		download_train_files(date_string, path, prefix)
-		d = DayParser(path, date_string)
-		d.parse_all_trains()
-		d.write_day_to_disk()
-		print("completed {}".format(date_string))
-
+		yield date_string, time.time() - download_started
+
+def download_days_in_background(days, path, prefix, prefetch):
+	"""Like download_days, but downloading from a thread up to prefetch days
+	ahead of the consumer. A download error is raised to the consumer."""
+	downloaded = queue.Queue()
+	# a day takes a slot before its download starts and frees it when the
+	# consumer takes it, so at most prefetch days are downloading or waiting
+	slots = threading.Semaphore(prefetch)
+	stopped = threading.Event()
+
+	def take_slot():
+		while not stopped.is_set():
+			if slots.acquire(timeout=1):
+				return True
+		return False
 
+	def download():
+		try:
+			for date_string in days:
+				if not take_slot():
+					return
+				download_started = time.time()
+				download_train_files(date_string, path, prefix)
+				downloaded.put(((date_string, time.time() - download_started), None))
+		except Exception as e:
+			downloaded.put((None, e))
+
+	downloader = threading.Thread(target=download)
+	downloader.daemon = True
+	downloader.start()
+	try:
+		for _ in days:
+			item, error = downloaded.get()
+			if error is not None:
+				raise error
+			slots.release()
+			yield item
+	finally:
+		# stops the downloader if the consumer gave up early
+		stopped.set()
@@ -1,16 +1,73 @@
 from datetime import datetime, timedelta
 import requests
-from bs4 import BeautifulSoup
 import time
-import pandas as pd
 from rail_data import dv_station_names as dv
+from rail_data.schedule import get_schedule, reload_schedule
+from dv_client import DVClient
+import dv_pages
+from dv_pages import clock_datetime
+from uploader import TrainUploader, S3Backend
+from checkpoint import Checkpoint
+from metrics import Metrics, LAG_BUCKETS
+from shards import ShardCoordinator
+from delay_service import DelayIndex
 import re
 import json
 import boto3
 import os
+import heapq
+import bisect
+import itertools
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 
-s3 = boto3.resource('s3')
+class Clock:
+	"""Wall clock used for all scheduling; harnesses swap in their own."""
+
+	def now(self):
+		return datetime.now()
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+
+class OffsetClock(Clock):
+	"""Runs at real speed, starting from start (e.g. a date in the GTFS feed)."""
+
+	def __init__(self, start):
+		self.offset = start - datetime.now()
+
+	def now(self):
+		return datetime.now() + self.offset
+
+
+class SimulatedClock(Clock):
+	"""Starts at start and only moves when slept on, for replays."""
+
+	def __init__(self, start):
+		self.time = start
+
+	def now(self):
+		return self.time
+
+	def sleep(self, seconds):
+		self.time = self.time + timedelta(seconds=seconds)
+
+
+clock = Clock()
+
+# created on first use, building the resource is slow
+s3 = None
+
+
+def get_s3():
+	global s3
+	if s3 is None:
+		s3 = boto3.resource('s3')
+	return s3
+
 
 TERMINALS = {
 	"New Bridge Landing":{"abbrev": "NH", "freq":3600},
@@ -53,40 +110,205 @@ TERMINALS = {
 	"Port Jervis":{"abbrev": "PO", "freq":1800}
 }
 
+# terminals whose DepartureVision name differs from rail_stations
+TERMINAL_STATIONS = {
+	"Newark Broad St": "Newark Broad Street",
+	"Bay St (Montclair)": "Bay Street",
+	"Montclair State University": "Montclair State U",
+	"Jersey Ave": "Jersey Avenue"
+}
+
+TERMINAL = "terminal"
+TRAIN = "train"
+
 TRAIN_COLUMN = 4
 LINE_COLUMN = 3
 DEP_COLUMN = 0
 RAIL_DATA = "./rail_data/"
 ALL_STATIONS = json.load(open(RAIL_DATA + 'rail_stations'))
 
-trip_stops = pd.DataFrame()
-trips = pd.read_csv(RAIL_DATA + 'trips.txt')
-stop_times = pd.read_csv(RAIL_DATA + 'stop_times.txt')
-trip_stops = stop_times.merge(trips, on=['trip_id'])
+METRICS = Metrics()
+
+# shared keep-alive client for every DepartureVision request
+DV = DVClient(metrics=METRICS)
+
+
+class FixedCadence:
+	"""Scrape a train every Train.freq seconds."""
+
+	def next_scrape(self, train):
+		return train.t_scrape + timedelta(seconds=train.freq)
+
+
+class ScheduleCadence:
+	"""Scrape densely around a train's next departure and sparsely between.
+
+	The next departure is the earliest time shown for a station the train
+	has not left on its latest status page, or failing that the next stop
+	in the GTFS schedule. In the window seconds up to and at it the train is
+	scraped every dense seconds; before that every sparse seconds, but never
+	later than the start of the window. Once the departure time has passed
+	without the page showing it (the train is late) it is scraped every
+	default seconds.
+	"""
+	time_re = re.compile(r".*?(\d+):(\d+).*")
+
+	def __init__(self, dense=30, sparse=600, window=60, default=60):
+		self.dense = timedelta(seconds=dense)
+		self.sparse = timedelta(seconds=sparse)
+		self.window = timedelta(seconds=window)
+		# used when nothing is known about the next departure
+		self.default = timedelta(seconds=default)
+
+	def page_stop(self, train, now):
+		"""(station, time) of the next departure on the latest page, or None."""
+		for station, status in dv_pages.station_statuses(train.page):
+			if station not in ALL_STATIONS or any(x in status for x in train.statuses):
+				continue
+			match = self.time_re.match(status)
+			if match is not None:
+				return station, clock_datetime(int(match.group(1)), int(match.group(2)), now)
+		return None
+
+	def page_event(self, train, now):
+		stop = self.page_stop(train, now)
+		return stop[1] if stop is not None else None
+
+	def schedule_event(self, train, now):
+		for arrival, stop_id, sequence in get_schedule(RAIL_DATA).get(train.created_at, train.id):
+			scheduled = train.schedule_datetime(arrival)
+			if scheduled >= now:
+				return scheduled
+		return None
+
+	def next_event(self, train, now):
+		event = self.page_event(train, now)
+		if event is None:
+			event = self.schedule_event(train, now)
+		return event
+
+	def next_scrape(self, train):
+		now = clock.now()
+		event = self.next_event(train, now)
+		if event is None:
+			return now + self.default
+		if now > event:
+			# late, or the page has not caught up yet
+			return now + self.default
+		if event - self.window <= now:
+			return now + self.dense
+		return min(now + self.sparse, event - self.window)
+
+
+class ScheduleExpiry:
+	"""Retire trains whose pages never show them leaving the system.
+
+	Idle scrapes are those that failed, came back empty or did not change
+	the page. A train in the schedule only counts them after its last
+	scheduled arrival (express runs can go longer than max_idle scrapes
+	between stations), and expires once max_idle of them are consecutive,
+	or at the first one more than tolerance seconds after that arrival; a
+	train whose page keeps changing is never retired, however late. A train
+	not in the schedule only counts idle scrapes once its page shows a
+	departure or its listed departure time has passed (pages do not change
+	while it waits to leave), and expires after max_idle of them or max_age
+	seconds after it was first seen.
+	"""
+
+	def __init__(self, tolerance=3600, max_idle=30, max_age=6 * 3600):
+		self.tolerance = timedelta(seconds=tolerance)
+		self.max_idle = max_idle
+		self.max_age = timedelta(seconds=max_age)
+
+	def scheduled_end(self, train):
+		stops = get_schedule(RAIL_DATA).get(train.created_at, train.id)
+		if not stops:
+			return None
+		return train.schedule_datetime(stops[-1][0])
+
+	def departed(self, train, now):
+		"""True once the train's page shows a departure or its listed
+		departure time has passed."""
+		for station, status in dv_pages.station_statuses(train.page):
+			if any(x in status for x in train.statuses):
+				return True
+		match = train.time_re.match(train.dep.replace("\r\n", ""))
+		if match is None:
+			return True
+		return now >= clock_datetime(int(match.group(1)), int(match.group(2)), train.created_at)
 
+	def check(self, train, now):
+		"""Return why train should be retired, or None."""
+		end = self.scheduled_end(train)
+		if end is None:
+			if not self.departed(train, now):
+				train.idle = 0
+			elif train.idle >= self.max_idle:
+				return "idle"
+			if now - train.created_at > self.max_age:
+				return "age"
+		elif now <= end:
+			train.idle = 0
+		elif train.idle >= self.max_idle:
+			return "idle"
+		elif now > end + self.tolerance and train.idle > 0:
+			return "schedule"
+		return None
 
-class Train:
+
+class Train(object):
+	# no per-instance __dict__, there can be hundreds of live trains
+	__slots__ = ("id", "line", "dep", "created_at", "scrape_count", "data", "page",
+				 "type", "buffer_mins", "scheduled", "t_scrape", "completed", "idle",
+				 "expired")
 	url = "http://dv.njtransit.com/mobile/train_stops.aspx?train="
 	freq = 60
 	statuses = ["DEPARTED", "Cancelled"]
-	time_re = re.compile(".*?(\d+):(\d+).*")
+	time_re = re.compile(r".*?(\d+):(\d+).*")
+	# store only changed lines after the first page (see dv_pages)
+	delta = False
+	# policy deciding when to scrape next, see FixedCadence/ScheduleCadence
+	cadence = FixedCadence()
+	# policy retiring trains that never complete, see ScheduleExpiry
+	expiry = ScheduleExpiry()
+	# minutes before the scheduled or listed departure to start scraping
+	buffers = {"NJ Transit": 2, "Amtrak": 30}
 
 	def __init__(self, train_id, line, dep):
 		self.id = train_id
 		self.line = line
 		self.dep = dep
-		self.created_at = datetime.now()
+		self.created_at = clock.now()
 		self.scrape_count = 0
 		self.data = []
+		self.page = []
 		self.type = self.get_type()
 		if self.type == "NJ Transit":
 			self.id = train_id.zfill(4) #TODO: format id
-			self.buffer_mins = 2
-		else:
-			self.buffer_mins = 30
+		self.buffer_mins = self.buffers[self.type]
 		self.scheduled = True
 		self.t_scrape = self.get_t_scrape()
 		self.completed = False
+		# consecutive failed, empty or unchanged scrapes
+		self.idle = 0
+		# why the train was retired before completing, if it was
+		self.expired = None
+
+	@classmethod
+	def from_state(cls, state, data):
+		"""Rebuild a train from checkpointed attributes and scrape data."""
+		train = cls.__new__(cls)
+		# not in checkpoints written before expiry existed
+		train.idle = 0
+		train.expired = None
+		for field, value in state.items():
+			setattr(train, field, value)
+		train.data = data
+		if data:
+			train.page = dv_pages.decode_pages(data)[-1][1]
+		else:
+			train.page = []
+		return train
 
 	def __str__(self):
 		return "Train #{}, {}, next scrape: {}".format(self.id, self.line, self.t_scrape)
@@ -98,12 +320,8 @@ class Train:
 		except ValueError: 
 			return "Amtrak"
 
-	def parse_table(self, soup):
-		table = soup.find('table')
-		if table is not None:
-			return [td.text for td in table.find_all('td')]
-		else:
-			return []
+	def parse_table(self, html):
+		return dv_pages.train_stops(html)
 
 	def schedule_datetime(self, scheduled):
 		hours, minutes, seconds = scheduled.split(":")
@@ -114,18 +332,25 @@ class Train:
 		return midnight + timedelta(hours=hours, minutes=minutes)
 
 	def get_scheduled_time(self):
-		try:
-			scheduled = trip_stops[trip_stops['block_id'] == self.id]['arrival_time'].iloc[0]
-			self.scheduled = True
-			scheduled = self.schedule_datetime(scheduled) - timedelta(minutes=self.buffer_mins)
-			if datetime.now() > scheduled:
-				scheduled = datetime.now()
-
-			return scheduled
-		except IndexError:
+		scheduled = get_schedule(RAIL_DATA).first_arrival(self.created_at, self.id)
+		if scheduled is None:
 			# train not in schedule
 			self.scheduled = False
 			return None
+		self.scheduled = True
+		scheduled = self.schedule_datetime(scheduled) - timedelta(minutes=self.buffer_mins)
+		if clock.now() > scheduled:
+			scheduled = clock.now()
+
+		return scheduled
+
+	def scheduled_times(self):
+		"""stop_id -> scheduled datetime, {} if the train is not in the schedule."""
+		times = {}
+		for arrival, stop_id, sequence in get_schedule(RAIL_DATA).get(self.created_at, self.id):
+			if stop_id not in times:
+				times[stop_id] = self.schedule_datetime(arrival)
+		return times
 
 	def parse_time(self, hour, minute):
 		hour, minute = int(hour), int(minute)
@@ -155,17 +380,20 @@ class Train:
 		if match is not None:
 			return self.parse_time(match.group(1), match.group(2))
 		else:
-			return datetime.now()
+			return clock.now()
 
 	def update_dep(self, dep):
+		"""Move the first scrape earlier if dep is; True if t_scrape changed."""
 		if not self.scheduled and not self.scrape_count:
 			approx_time = self.approx_dep_time(dep)
 			if approx_time < self.t_scrape:
 				self.t_scrape = approx_time
 				self.dep = dep
+				return True
+		return False
 
 	def stop_scraping(self):
-		latest_data = self.data[-1][1]
+		latest_data = self.page
 		left_system = True
 
 		for stop in latest_data:
@@ -188,88 +416,351 @@ class Train:
 			if self.stop_scraping():
 				self.completed = True
 				return None
-			return self.t_scrape + timedelta(seconds=self.freq)
+			return self.cadence.next_scrape(self)
 
 	def request(self, timeout=3, retry=False):
 		try:
-			resp = requests.get(self.url + self.id, timeout=timeout)
+			resp = DV.get(self.url + self.id, timeout=timeout,
+						  retries=None if retry else 0)
 			if resp.status_code == 200:
-				soup = BeautifulSoup(resp.text, "lxml")
-				status = self.parse_table(soup)
+				status = self.parse_table(resp.text)
 				return status
 			else:
-				print("response code {} for {} at {}".format(resp.status_code, self.id, datetime.now()))
+				print("response code {} for {} at {}".format(resp.status_code, self.id, clock.now()))
 				return None
 		except requests.exceptions.RequestException:
-			if retry:
-				print("retrying")
-				return self.request(timeout=timeout, retry=True)
-			else:
-				return None
+			return None
 
 	def scrape(self):
-		now = datetime.now()
+		now = clock.now()
 		data = self.request()
+		if not data or data == self.page:
+			self.idle = self.idle + 1
+		else:
+			self.idle = 0
 		if data is not None:
 			self.scrape_count = self.scrape_count + 1
-			self.data.append([now, data])
+			if self.delta and self.data:
+				self.data.append([now, dv_pages.page_delta(self.page, data), len(data)])
+			else:
+				self.data.append([now, data])
+			self.page = data
 			self.t_scrape = self.get_t_scrape()
+		if not self.completed:
+			self.expired = self.expiry.check(self, now)
+			if self.expired is not None:
+				self.completed = True
 
-	def write_to_file(self):
+	def to_json(self):
 		data_dict = {"id": self.id, "line": self.line, 
 					 "created_at": self.created_at, "type": self.type, 
 					 "scrape_count": self.scrape_count,
 					 "scheduled": self.scheduled, "data": self.data}
+		if self.delta:
+			data_dict["encoding"] = "delta"
+		if self.expired is not None:
+			data_dict["expired"] = self.expired
+		return json.dumps(data_dict, default=str)
+
+	def file_name(self):
+		return '{}_{}'.format(self.created_at.strftime("%Y_%m_%d"), self.id)
 
-		date_str = self.created_at.strftime("%Y_%m_%d")
-		file_name = '{}_{}'.format(date_str, self.id)
+	def s3_key(self):
+		return 'aws/{}/{}'.format(self.created_at.strftime("%Y_%m_%d"), self.file_name())
+
+	def write_to_file(self):
+		file_name = self.file_name()
 		with open('trains/' + file_name, 'a') as outfile:
-			json.dump(data_dict, outfile, default=str)
+			outfile.write(self.to_json())
 			outfile.close()
 
 		data = open('trains/' + file_name, 'rb')
-		s3.Bucket('njtransit').put_object(Key='aws/{}/{}'.format(date_str, file_name), Body=data)
+		get_s3().Bucket('njtransit').put_object(Key=self.s3_key(), Body=data)
 		try:
 			os.remove('trains/' + file_name)
 		except OSError:
 			print('trains/{} does not exist'.format(file_name))
 
 
+class CompletedTrain(object):
+	"""What is kept of a train once it is completed and handed off for upload."""
+	__slots__ = ("id", "completed_at", "uploaded")
+
+	def __init__(self, train_id, completed_at, uploaded=False):
+		self.id = train_id
+		self.completed_at = completed_at
+		self.uploaded = uploaded
+
+
+class TerminalPolling:
+	"""Time-of-day polling intervals for each terminal from GTFS departures.
+
+	A terminal board lists the next board_size departures, so polling again
+	before the last of them leaves means no train is missed. The interval is
+	the time from now until the board_size-th next departure, less a margin,
+	clamped to [min_freq, max_freq]. Terminals without a GTFS stop keep
+	their fixed TERMINALS freq.
+
+	Departures are loaded for one service day at a time and reloaded when
+	the day changes or the GTFS files are modified.
+	"""
+
+	def __init__(self, terminals, board_size=10, margin=120, min_freq=120,
+				 max_freq=3600):
+		self.terminals = terminals
+		self.board_size = board_size
+		self.margin = margin
+		self.min_freq = min_freq
+		self.max_freq = max_freq
+		self.day = None
+		self.departures = {}
+
+	def stop_id(self, name):
+		return ALL_STATIONS.get(TERMINAL_STATIONS.get(name, name))
+
+	def refresh(self, now):
+		if get_schedule(RAIL_DATA).stale():
+			print("GTFS files changed, reloading schedule")
+			reload_schedule(RAIL_DATA)
+			self.day = None
+		if self.day == now.date():
+			return
+		self.day = now.date()
+		self.departures = {}
+		for name in self.terminals:
+			stop_id = self.stop_id(name)
+			if stop_id is not None:
+				departures = get_schedule(RAIL_DATA).stop_departures(now, stop_id)
+				if departures:
+					self.departures[name] = departures
+
+	def interval(self, name, now):
+		"""Seconds until terminal name should be polled again."""
+		self.refresh(now)
+		if name not in self.departures:
+			return self.terminals[name]['freq']
+		departures = self.departures[name]
+		seconds = now.hour * 3600 + now.minute * 60 + now.second
+		last = bisect.bisect_left(departures, seconds) + self.board_size - 1
+		if last >= len(departures):
+			return self.max_freq
+		return max(self.min_freq, min(self.max_freq, departures[last] - seconds - self.margin))
+
+
+class Sightings:
+	"""Terminal board rows of one scraping loop, merged to one row per train.
+
+	A train listed on several boards keeps the row with its earliest
+	departure, so find_new_trains sees it (and updates it) once.
+	"""
+	time_re = re.compile(r".*?(\d+):(\d+).*")
+
+	def __init__(self, now):
+		# minutes past 12 o'clock on a 12h dial
+		self.dial = (now.hour % 12) * 60 + now.minute
+		# train id -> row, in order of first sighting
+		self.trains = {}
+		# dep string -> departure, only parsed for trains seen more than once
+		self.departures = {}
+
+	def departure(self, dep):
+		"""Minutes from now to the departure shown, nearest way round the dial
+		(orders departures like clock_datetime, without building datetimes).
+		Unreadable times sort last."""
+		if dep not in self.departures:
+			match = self.time_re.match(dep)
+			if match is None:
+				self.departures[dep] = 720
+			else:
+				minutes = (int(match.group(1)) % 12) * 60 + int(match.group(2))
+				self.departures[dep] = (minutes - self.dial + 360) % 720 - 360
+		return self.departures[dep]
+
+	def add(self, rows):
+		for row in rows:
+			seen = self.trains.get(row['train_id'])
+			if seen is None or self.departure(row['dep']) < self.departure(seen['dep']):
+				self.trains[row['train_id']] = row
+
+	def rows(self):
+		return list(self.trains.values())
+
+
+class TokenBucket:
+	"""Request budget of rate requests per second, saving up at most burst."""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = burst if burst is not None else max(1.0, self.rate)
+		self.tokens = self.burst
+		self.updated = None
+
+	def refill(self, now):
+		if self.updated is not None:
+			elapsed = (now - self.updated).total_seconds()
+			self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+		self.updated = now
+
+	def available(self, now):
+		self.refill(now)
+		return max(0, int(self.tokens))
+
+	def take(self, now, count=1):
+		"""Spend count tokens; may go into debt, which later requests repay."""
+		self.refill(now)
+		self.tokens = self.tokens - count
+
+	def delay(self, now, count=1):
+		"""Seconds until count tokens are available."""
+		self.refill(now)
+		return max(0.0, (count - self.tokens) / self.rate)
+
+
+class TrainPriority:
+	"""Ranks due trains when the request budget cannot cover them all.
+
+	A scrape only reduces timestamp error once the train's next departure
+	(from its latest page, else the schedule) has passed, so a train scores
+	the seconds since the later of that departure and its last scrape:
+	roughly the error a scrape now would remove. Departures from terminals
+	count terminal_weight times and line_weights can favour some lines.
+	Every overdue second adds overdue_weight, so deferred trains whose
+	next departure is still ahead are not starved.
+	"""
+
+	def __init__(self, terminal_weight=2.0, overdue_weight=0.25, line_weights=None):
+		self.terminal_weight = terminal_weight
+		self.overdue_weight = overdue_weight
+		self.line_weights = line_weights or {}
+		self.events = ScheduleCadence()
+		self.terminal_stations = set(TERMINAL_STATIONS.get(name, name) for name in TERMINALS)
+
+	def score(self, train, now):
+		value = 0.0
+		stop = self.events.page_stop(train, now)
+		if stop is not None:
+			station, event = stop
+		else:
+			# not scraped yet, or nothing on the page: use the schedule
+			station, event = None, self.events.schedule_event(train, now)
+		if event is not None and event <= now:
+			last_scrape = train.data[-1][0] if train.data else train.created_at
+			value = (now - max(event, last_scrape)).total_seconds()
+			if station in self.terminal_stations:
+				value = value * self.terminal_weight
+			value = value * self.line_weights.get(train.line, 1.0)
+		overdue = max(0.0, (now - train.t_scrape).total_seconds())
+		return value + overdue * self.overdue_weight
+
+
+class ScrapeQueue:
+	"""Min-heap of (t_scrape, kind, key) entries for terminals and trains.
+
+	Entries are never removed in place; the scraper drops superseded ones
+	when they are popped.
+	"""
+
+	def __init__(self):
+		self.heap = []
+		# tie-breaker so entries with equal times never compare keys
+		self.counter = itertools.count()
+
+	def __len__(self):
+		return len(self.heap)
+
+	def push(self, t_scrape, kind, key):
+		heapq.heappush(self.heap, (t_scrape, next(self.counter), kind, key))
+
+	def next_time(self):
+		if not self.heap:
+			return None
+		return self.heap[0][0]
+
+	def pop_due(self, now):
+		due = []
+		while self.heap and self.heap[0][0] <= now:
+			t_scrape, _, kind, key = heapq.heappop(self.heap)
+			due.append((t_scrape, kind, key))
+		return due
+
+
 class TerminalScraper:
 	terminal_url = "http://dv.njtransit.com/mobile/tid-mobile.aspx?sid="
+	# maximum number of DepartureVision requests in flight at once
+	max_workers = 16
+	# seconds to wait before retrying a failed train request
+	retry_delay = 10
+	# seconds between writes of the metrics file
+	metrics_interval = 15
+	train_class = Train
 
-	def __init__(self):
-		self.time = datetime.now()
+	def __init__(self, max_workers=None, uploader=None, checkpoint=None,
+				 polling=None, metrics_path=None, budget=None, priority=None, delays=None):
+		self.time = clock.now()
 		self.terminals = TERMINALS
-		for term, info in self.terminals.iteritems():
+		for term, info in self.terminals.items():
 			info['t_scrape'] = self.time
 
+		if max_workers is not None:
+			self.max_workers = max_workers
+		self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+		DV.ensure_pool_size(self.max_workers)
+		# completed trains are written inline when there is no uploader
+		self.uploader = uploader
+		# s3 key -> (train id, Train) of completed trains waiting on the
+		# uploader; the Train is kept, and checkpointed, until it is uploaded
+		# or spooled to disk
+		self.uploading = {}
+		if self.uploader is not None:
+			self.uploader.on_upload = self.mark_uploaded
+			self.uploader.on_spool = self.mark_spooled
+		# fixed TERMINALS frequencies are used when there is no polling schedule
+		self.polling = polling
+		# optional TokenBucket limiting requests; when it runs short, due
+		# trains are ranked by priority (a TrainPriority), else oldest first
+		self.budget = budget
+		self.priority = priority
+		# optional delay_service.DelayIndex kept up to date with every scrape
+		self.delays = delays
+
 		self.current_trains = {}
 		self.completed_trains = {}
-		self.time = datetime.now()
+		self.time = clock.now()
 
-	def parse_table(self, soup):
-		tables = soup.find_all('table')
-		if not len(tables):
-			return []
-		else:
-			trains = []
-			for table in tables:
-				if table.parent.name == 'td':
-					row = table
-					cells = row.find_all('td')
-					trains.append({'train_id': cells[TRAIN_COLUMN].text, 
-								   'line': cells[LINE_COLUMN].text,
-								   'dep': cells[DEP_COLUMN].text})
+		self.metrics_path = metrics_path
+		self.metrics_written = None
+		self.register_metrics()
+
+		self.checkpoint = checkpoint
+		if self.checkpoint is not None:
+			restored = self.checkpoint.restore(self, self.train_class, CompletedTrain)
+			print("restored {} trains from checkpoint".format(restored))
+
+		self.queue = ScrapeQueue()
+		self.queued = {}
+		for term, info in self.terminals.items():
+			self.schedule(TERMINAL, term, info['t_scrape'])
+		for train_id in self.current_trains:
+			self.schedule_train(train_id)
+
+	def parse_table(self, html):
+		trains = []
+		for cells in dv_pages.departure_rows(html):
+			trains.append({'train_id': cells[TRAIN_COLUMN],
+						   'line': cells[LINE_COLUMN],
+						   'dep': cells[DEP_COLUMN]})
 		return trains
 
+	def polls(self, abbrev):
+		"""True if get_departures sends a request for terminal abbrev."""
+		return True
+
 	#TODO: change scrape time here
 	def get_departures(self, abbrev):
 		try:
-			resp = requests.get(self.terminal_url + abbrev, timeout=3)
+			resp = DV.get(self.terminal_url + abbrev, timeout=3)
 			if resp.status_code == 200:
-				soup = BeautifulSoup(resp.text, "lxml")
-				return self.parse_table(soup)
+				return self.parse_table(resp.text)
 			else:
 				return []
 		except requests.exceptions.ReadTimeout:
@@ -296,72 +787,335 @@ class TerminalScraper:
 				if not train['train_id'] in self.current_trains:
 					if not train['train_id'] in self.completed_trains:
 						new_trains.append(train)
-				else:
-					# update dep time of current train
-					self.current_trains[train['train_id']].update_dep(train['dep'])
+				elif self.current_trains[train['train_id']].update_dep(train['dep']):
+					# an earlier dep time moved the first scrape; otherwise the
+					# queued time stands (it may be a retry or a deferral)
+					self.schedule_train(train['train_id'])
 
 		return new_trains
 
 	def create_new_trains(self, trains):
 		for train in trains:
 			if not train['train_id'] in self.current_trains:
-				train_obj = Train(train['train_id'], train['line'], train['dep'])
+				train_obj = self.train_class(train['train_id'], train['line'], train['dep'])
 				self.current_trains[train['train_id']] = train_obj
-			else:
-				self.current_trains[train['train_id']].update_dep(train['dep'])
+			elif not self.current_trains[train['train_id']].update_dep(train['dep']):
+				continue
+			self.schedule_train(train['train_id'])
 
 	def scrape_terminals(self, terminals):
-		all_trains = []
-		for name in terminals:
+		# fetch all due terminals in parallel, results come back in order
+		abbrevs = [self.terminals[name]['abbrev'] for name in terminals]
+		departures = self.pool.map(self.get_departures, abbrevs)
+		sightings = Sightings(self.time)
+		for name, trains in zip(terminals, departures):
 			terminal = self.terminals[name]
-			trains = self.get_departures(terminal['abbrev'])
-			#TODO: get unique
-			self.terminals[name]['t_scrape'] = terminal['t_scrape'] + timedelta(seconds = terminal['freq'])
-			all_trains = all_trains + trains
-		return all_trains
+			if self.polling is not None:
+				freq = self.polling.interval(name, self.time)
+				self.terminals[name]['t_scrape'] = self.time + timedelta(seconds = freq)
+			else:
+				self.terminals[name]['t_scrape'] = terminal['t_scrape'] + timedelta(seconds = terminal['freq'])
+			sightings.add(trains)
+		return sightings.rows()
+
+	def scrape_trains(self, trains):
+		# each train appears at most once per batch, so its scrapes stay
+		# ordered even though different trains are fetched concurrently
+		for _ in self.pool.map(lambda train: train.scrape(), trains):
+			pass
+
+	def register_metrics(self):
+		METRICS.gauge("scraper_active_trains", "Trains being scraped",
+					  fn=lambda: len(self.current_trains))
+		METRICS.gauge("scraper_completed_trains", "Trains completed today",
+					  fn=lambda: len(self.completed_trains))
+		METRICS.gauge("scraper_queue_entries", "Entries in the scrape queue",
+					  fn=lambda: len(self.queue))
+		if self.uploader is not None:
+			METRICS.gauge("upload_queue_depth", "Completed trains waiting for upload",
+						  fn=self.uploader.depth)
+			METRICS.gauge("upload_uploaded", "Completed trains uploaded",
+						  fn=lambda: self.uploader.uploaded)
+			METRICS.gauge("upload_failed", "Uploads spooled after failing",
+						  fn=lambda: self.uploader.failed)
+		METRICS.gauge("dv_connections_reused", "Requests sent on a reused connection",
+					  fn=lambda: DV.stats()["reused"])
+
+	def write_metrics(self):
+		if self.metrics_path is None:
+			return
+		if self.metrics_written is None or \
+				(self.time - self.metrics_written).total_seconds() >= self.metrics_interval:
+			METRICS.write(self.metrics_path)
+			self.metrics_written = self.time
+
+	def schedule(self, kind, key, t_scrape):
+		# a later call for the same item supersedes any entry still queued
+		self.queued[(kind, key)] = t_scrape
+		self.queue.push(t_scrape, kind, key)
+
+	def schedule_train(self, train_id):
+		train = self.current_trains[train_id]
+		if self.queued.get((TRAIN, train_id)) != train.t_scrape:
+			self.schedule(TRAIN, train_id, train.t_scrape)
+
+	def pop_due(self, now):
+		terminals, trains = [], []
+		for t_scrape, kind, key in self.queue.pop_due(now):
+			if self.queued.get((kind, key)) != t_scrape:
+				# superseded by a reschedule, or train already completed
+				continue
+			del self.queued[(kind, key)]
+			METRICS.histogram("scrape_lag_seconds", "Delay between t_scrape and the scrape",
+							  buckets=LAG_BUCKETS, kind=kind).observe((now - t_scrape).total_seconds())
+			if kind == TERMINAL:
+				terminals.append(key)
+			elif key in self.current_trains:
+				trains.append(key)
+		return terminals, trains
+
+	def ration(self, train_ids, now):
+		"""Return the due trains the request budget allows, best first, and
+		requeue the rest for when the budget has refilled."""
+		allowed = self.budget.available(now)
+		if allowed >= len(train_ids):
+			self.budget.take(now, len(train_ids))
+			return train_ids
+		if self.priority is not None:
+			ranked = sorted(train_ids, reverse=True,
+							key=lambda t: self.priority.score(self.current_trains[t], now))
+		else:
+			ranked = sorted(train_ids, key=lambda t: self.current_trains[t].t_scrape)
+		chosen, deferred = ranked[:allowed], ranked[allowed:]
+		self.budget.take(now, len(chosen))
+		retry_at = now + timedelta(seconds=max(1.0, self.budget.delay(now)))
+		for train_id in deferred:
+			self.schedule(TRAIN, train_id, retry_at)
+		METRICS.counter("scrapes_deferred_total", "Train scrapes deferred by the request budget").inc(len(deferred))
+		return chosen
+
+	def complete_train(self, train_id):
+		train = self.current_trains.pop(train_id)
+		if self.delays is not None:
+			self.delays.remove(train.id)
+		if train.expired is not None:
+			print("expired {} ({})".format(train_id, train.expired))
+			METRICS.counter("trains_expired_total", "Trains retired without completing",
+							reason=train.expired).inc()
+		else:
+			print("completed {}".format(train_id))
+		self.queued.pop((TRAIN, train_id), None)
+		METRICS.histogram("train_requests", "Successful scrapes per completed train",
+						  buckets=[1, 5, 10, 25, 50, 100, 200, 500]).observe(train.scrape_count)
+		# only the id is kept once the train's data is uploaded
+		self.completed_trains[train_id] = CompletedTrain(train.id, self.time)
+		self.upload_train(train_id, train)
+
+	def upload_train(self, train_id, train):
+		if self.uploader is not None:
+			self.uploading[train.s3_key()] = (train_id, train)
+			self.uploader.submit(train.s3_key(), train.to_json())
+		else:
+			train.write_to_file()
+			self.completed_trains[train_id].uploaded = True
+
+	def mark_uploaded(self, key):
+		# called from uploader threads
+		train_id, train = self.uploading.pop(key, (None, None))
+		record = self.completed_trains.get(train_id)
+		if record is not None:
+			record.uploaded = True
+
+	def mark_spooled(self, key):
+		# the spool holds the train's data now, drop it from memory
+		train_id, train = self.uploading.get(key, (None, None))
+		if train_id is not None:
+			self.uploading[key] = (train_id, None)
+
+	def step(self):
+		started = time.time()
+		now = clock.now()
+		if now.day != self.time.day:
+			# trains still waiting on the uploader keep their record, so the
+			# checkpoint logs their upload
+			uploading = set(train_id for train_id, train in list(self.uploading.values()))
+			self.completed_trains = dict((key, record) for key, record in self.completed_trains.items()
+										 if key in uploading)
+		self.time = now
+
+		scrape_terms, scrape_trains = self.pop_due(now)
+		if self.budget is not None:
+			# terminal boards are never deferred, they are how trains are found;
+			# only boards actually requested are charged
+			self.budget.take(now, sum(1 for name in scrape_terms
+									  if self.polls(self.terminals[name]['abbrev'])))
+			scrape_trains = self.ration(scrape_trains, now)
+
+		all_trains = self.scrape_terminals(scrape_terms)
+		for name in scrape_terms:
+			self.schedule(TERMINAL, name, self.terminals[name]['t_scrape'])
+		new_trains = self.find_new_trains(all_trains)
+		self.create_new_trains(new_trains)
+
+		self.scrape_trains([self.current_trains[t] for t in scrape_trains])
+		for train_id in scrape_trains:
+			train = self.current_trains[train_id]
+			if self.delays is not None and train.page:
+				self.delays.update(train, train.scheduled_times(), now)
+			if train.completed:
+				self.complete_train(train_id)
+			elif train.t_scrape <= now:
+				# request failed, try again shortly
+				self.schedule(TRAIN, train_id, now + timedelta(seconds=self.retry_delay))
+			else:
+				self.schedule_train(train_id)
+
+		if self.checkpoint is not None:
+			self.checkpoint.save(self)
+
+		METRICS.histogram("scraper_step_seconds", "Time spent in one scraping loop",
+						  buckets=LAG_BUCKETS).observe(time.time() - started)
+		self.write_metrics()
+
+	def wait(self):
+		next_time = self.queue.next_time()
+		if next_time is None:
+			delay = self.retry_delay
+		else:
+			delay = (next_time - clock.now()).total_seconds()
+		if delay > 0:
+			clock.sleep(delay)
 
-	#TODO: refactor
 	def run(self):
 		loop_count = 1
 		while True:
-			now = datetime.now()
-			if now.day != self.time.day:
-				self.completed_trains = {}
-
-			self.time = now
-			#identify terminals to scrape
-			scrape_terms = []
-			for term, info in self.terminals.iteritems():
-				if (info['t_scrape'] <= self.time):
-					scrape_terms.append(term)
-
-			all_trains = self.scrape_terminals(scrape_terms)
-			new_trains = self.find_new_trains(all_trains)
-			self.create_new_trains(new_trains)
-
-			completed = []
-			for train_id, train in self.current_trains.iteritems():
-				if train.completed:
-					print("completed {}".format(train_id))
-					self.completed_trains[train_id] = train
-					completed.append(train_id)
-					train.write_to_file()
-				else:
-					if (train.t_scrape <= self.time):
-						train.scrape()
-			
-			for c in completed:
-				self.current_trains.pop(c, 0)
-			# self.scrape_trains(scrape_trains)
+			self.step()
 			if not (loop_count % 50):
 				print("loop count: {}".format(loop_count))
 			loop_count = loop_count + 1
-			time.sleep(10)
+			self.wait()
+
+class ShardedScraper(TerminalScraper):
+	"""A TerminalScraper that owns a share of the terminals and trains.
+
+	Ownership is coordinated with the other shards through a
+	shards.ShardCoordinator; sightings of trains owned elsewhere are handed
+	to their owner instead of being scraped here.
+	"""
+
+	def __init__(self, coordinator, **kwargs):
+		self.coordinator = coordinator
+		self.coordinator.join()
+		TerminalScraper.__init__(self, **kwargs)
+		# trains restored from the checkpoint may have been adopted by another shard
+		day = self.day()
+		for train_id, train in list(self.current_trains.items()):
+			sighting = {'train_id': train_id, 'line': train.line, 'dep': train.dep}
+			if not self.coordinator.claim(day, sighting):
+				del self.current_trains[train_id]
+				self.queued.pop((TRAIN, train_id), None)
+
+	def day(self):
+		return self.time.strftime("%Y-%m-%d")
+
+	def polls(self, abbrev):
+		return self.coordinator.owns(TERMINAL + ":" + abbrev)
+
+	def get_departures(self, abbrev):
+		if not self.polls(abbrev):
+			return []
+		return TerminalScraper.get_departures(self, abbrev)
+
+	def find_new_trains(self, trains):
+		day = self.day()
+		sightings = Sightings(self.time)
+		sightings.add(self.coordinator.route(day, trains))
+		sightings.add(self.coordinator.receive())
+		sightings.add(self.coordinator.orphans(day))
+		new_trains = TerminalScraper.find_new_trains(self, sightings.rows())
+		return [train for train in new_trains if self.coordinator.claim(day, train)]
+
+	def complete_train(self, train_id):
+		TerminalScraper.complete_train(self, train_id)
+		self.coordinator.complete(train_id)
+
+	def step(self):
+		day = self.day()
+		self.coordinator.heartbeat()
+		TerminalScraper.step(self)
+		if self.day() != day:
+			self.coordinator.prune(self.day())
+
+	def wait(self):
+		# keep heartbeating (and picking up routed sightings) while idle
+		next_time = self.queue.next_time()
+		interval = self.coordinator.heartbeat_interval
+		if next_time is None or (next_time - clock.now()).total_seconds() > interval:
+			clock.sleep(interval)
+		else:
+			TerminalScraper.wait(self)
+
+
+def budget_options(rate):
+	if rate is None:
+		return {}
+	return {'budget': TokenBucket(rate, burst=rate * 10), 'priority': TrainPriority()}
+
+
+def run_shard(shard, db_path='trains/shards.db', budget=None):
+	coordinator = ShardCoordinator(db_path, shard)
+	scraper = ShardedScraper(coordinator,
+							 uploader=TrainUploader(S3Backend('njtransit'),
+													spool_dir='trains/spool-{}/'.format(shard)),
+							 checkpoint=Checkpoint('trains/checkpoint-{}.log'.format(shard)),
+							 polling=TerminalPolling(TERMINALS),
+							 metrics_path='trains/metrics-{}.prom'.format(shard),
+							 **budget_options(budget))
+	try:
+		scraper.run()
+	finally:
+		coordinator.leave()
 
 
 def main():
-	scraper = TerminalScraper()
-	scraper.run()
+	parser = argparse.ArgumentParser(description="Scrape DepartureVision train statuses")
+	parser.add_argument('--shards', type=int, default=1,
+						help='number of worker processes to split trains between')
+	parser.add_argument('--shard', default=None,
+						help='run a single named shard (e.g. to add a worker)')
+	parser.add_argument('--budget', type=float, default=None,
+						help='DepartureVision requests per second (per shard)')
+	parser.add_argument('--delay-port', type=int, default=None,
+						help='serve live delays on this port (not with --shards)')
+	args = parser.parse_args()
+	# a shard only sees the trains it owns, so its index would be partial
+	if args.delay_port is not None and (args.shard is not None or args.shards > 1):
+		parser.error("--delay-port cannot be used with --shards or --shard")
+
+	if args.shard is not None:
+		run_shard(args.shard, budget=args.budget)
+	elif args.shards > 1:
+		processes = [multiprocessing.Process(target=run_shard, args=("shard-{}".format(i),),
+											 kwargs={'budget': args.budget},
+											 name="shard-{}".format(i))
+					 for i in range(args.shards)]
+		for process in processes:
+			process.start()
+		for process in processes:
+			process.join()
+			print("{} exited with code {}".format(process.name, process.exitcode))
+	else:
+		delays = None
+		if args.delay_port is not None:
+			delays = DelayIndex(ALL_STATIONS)
+			delays.serve(args.delay_port)
+		scraper = TerminalScraper(uploader=TrainUploader(S3Backend('njtransit')),
+								  checkpoint=Checkpoint('trains/checkpoint.log'),
+								  polling=TerminalPolling(TERMINALS),
+								  metrics_path='trains/metrics.prom',
+								  delays=delays,
+								  **budget_options(args.budget))
+		scraper.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+"""Background upload of completed train files.
+
+TerminalScraper hands each completed train to a TrainUploader, which
+queues it and uploads it from worker threads so the scraping loop never
+waits on S3. Uploads are gzip-compressed, retried with backoff and, if
+the backend stays unreachable (or the queue is full), spooled to local
+disk and retried later.
+"""
+import gzip
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+
+import boto3
+
+# suffix of spool files still being written
+TMP_SUFFIX = '.tmp'
+
+
+class S3Backend:
+	"""Puts objects in an S3 bucket."""
+
+	def __init__(self, bucket='njtransit'):
+		self.bucket = boto3.resource('s3').Bucket(bucket)
+
+	def put(self, key, body, compressed=False):
+		extra = {'ContentEncoding': 'gzip'} if compressed else {}
+		self.bucket.put_object(Key=key, Body=body, **extra)
+
+
+class FileBackend:
+	"""Writes objects to files under root, standing in for S3 locally."""
+
+	def __init__(self, root):
+		self.root = root
+
+	def put(self, key, body, compressed=False):
+		path = os.path.join(self.root, key)
+		directory = os.path.dirname(path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		with open(path, 'wb') as outfile:
+			outfile.write(body)
+
+
+class TrainUploader:
+	"""Bounded queue of (key, body) uploads drained by worker threads.
+
+	Keyword arguments:
+	backend -- object with put(key, body, compressed), e.g. S3Backend
+	workers -- number of concurrent uploads
+	max_queue -- uploads held in memory before new ones go to the spool
+	compress -- gzip bodies before upload
+	retries -- attempts per upload before spooling it
+	spool_dir -- local directory for uploads that could not be sent
+	spool_interval -- seconds between attempts to resend spooled uploads
+	on_upload -- optional callback(key) run after each successful upload
+	on_spool -- optional callback(key) run after an upload is spooled
+	"""
+
+	def __init__(self, backend, workers=4, max_queue=1000, compress=True,
+				 retries=3, backoff=1, spool_dir='trains/spool/',
+				 spool_interval=300, on_upload=None, on_spool=None):
+		self.backend = backend
+		self.compress = compress
+		self.retries = retries
+		self.backoff = backoff
+		self.spool_dir = spool_dir
+		self.spool_interval = spool_interval
+		self.on_upload = on_upload
+		self.on_spool = on_spool
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.lock = threading.Lock()
+		self.uploaded = 0
+		self.failed = 0
+		self.stopped = threading.Event()
+
+		self.threads = [threading.Thread(target=self.work) for _ in range(workers)]
+		self.threads.append(threading.Thread(target=self.resend_spooled))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def depth(self):
+		return self.queue.qsize()
+
+	def submit(self, key, body):
+		"""Queue body for upload under key without blocking."""
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		try:
+			self.queue.put_nowait((key, body))
+		except queue.Full:
+			print("upload queue full, spooling {}".format(key))
+			self.spool(key, body)
+
+	def upload(self, key, body):
+		if self.compress:
+			body = gzip.compress(body)
+		for attempt in range(self.retries):
+			try:
+				self.backend.put(key, body, compressed=self.compress)
+				with self.lock:
+					self.uploaded = self.uploaded + 1
+				if self.on_upload is not None:
+					self.on_upload(key)
+				return True
+			except Exception as e:
+				print("upload of {} failed ({})".format(key, e))
+				time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+		with self.lock:
+			self.failed = self.failed + 1
+		return False
+
+	def work(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				return
+			key, body = item
+			try:
+				if not self.upload(key, body):
+					self.spool(key, body)
+			finally:
+				self.queue.task_done()
+
+	def spool_path(self, key):
+		return os.path.join(self.spool_dir, key)
+
+	def spool(self, key, body):
+		path = self.spool_path(key)
+		directory = os.path.dirname(path)
+		if not os.path.exists(directory):
+			os.makedirs(directory, exist_ok=True)
+		# resend_spooled must never read a half-written file
+		fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX, dir=directory)
+		with os.fdopen(fd, 'wb') as outfile:
+			outfile.write(body)
+			outfile.flush()
+			os.fsync(outfile.fileno())
+		os.replace(tmp_path, path)
+		if self.on_spool is not None:
+			self.on_spool(key)
+
+	def spooled_keys(self):
+		keys = []
+		for root, dirs, files in os.walk(self.spool_dir):
+			for filename in files:
+				if filename.endswith(TMP_SUFFIX):
+					# being written, or left by a crash mid-write
+					continue
+				path = os.path.join(root, filename)
+				keys.append(os.path.relpath(path, self.spool_dir).replace(os.sep, '/'))
+		return keys
+
+	def resend_spooled(self):
+		while not self.stopped.wait(self.spool_interval):
+			for key in self.spooled_keys():
+				path = self.spool_path(key)
+				with open(path, 'rb') as infile:
+					body = infile.read()
+				if self.upload(key, body):
+					os.remove(path)
+
+	def close(self, timeout=None):
+		"""Finish queued uploads and stop the workers."""
+		self.stopped.set()
+		for _ in self.threads[:-1]:
+			self.queue.put(None)
+		for thread in self.threads[:-1]:
+			thread.join(timeout)